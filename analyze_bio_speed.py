@@ -1,7 +1,6 @@
 """ Analysis of original Bio.pairwise2 code performance """
 from timeit import default_timer as timer
 from Bio import pairwise2
-import matplotlib.pyplot as plt
 from Bio.pairwise2 import rint
 
 import test_optimization as optimization
@@ -133,6 +132,7 @@ class TimedAlign(pairwise2.align.alignment_function):
 
 def draw_bar_chart(description):
     """ Plots bar chart of execution times measured so far by TimedAlign class """
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots()
     values = [TimedAlign.preparation_time, TimedAlign.make_score_matrix_time,
               TimedAlign.find_starts_time, TimedAlign.filter_starts_time,
@@ -12,12 +12,13 @@ def random_char_list(alphabet, length):
     return [random.choice(alphabet) for _ in xrange(length)]
 
 
-def generate_sample(alphabet, length):
-    """ Generates pair of sequences with some changes between them. """
+def generate_sample(alphabet, length, similarity=None):
+    """ Generates pair of sequences with some changes between them.
+        Similarity (from 0 to 1) is a chance of keeping each symbol unchanged, random if not given. """
     seq1 = random_char_list(alphabet, length)
     seq2 = seq1[:]
 
-    randomness = random.random()
+    randomness = random.random() if similarity is None else 1 - similarity
     last_deleted = False
 
     i = 0
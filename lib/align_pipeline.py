@@ -0,0 +1,217 @@
+"""Streaming alignment of pairs of sequences from FASTA files.
+
+Pairs are read lazily, aligned by a pool of processes with a bounded number of pairs in flight,
+and results are written as soon as they are ready, in order of pairs, as TSV or JSON lines.
+Throughput and peak memory usage are reported at the end.
+
+Usage: python -m lib.align_pipeline [options] FASTA [FASTA ...]
+"""
+import argparse
+import collections
+import gzip
+import itertools
+import json
+import multiprocessing
+import resource
+import sys
+from timeit import default_timer as timer
+from . import optimized_pairwise2
+
+FASTA_HEADER = '>'
+
+ALIGNMENT_FIELDS = ('alignedA', 'alignedB', 'score', 'begin', 'end')
+
+TSV_COLUMNS = ('index', 'idA', 'idB', 'lengthA', 'lengthB', 'score', 'alignedA', 'alignedB', 'begin', 'end')
+
+
+def open_fasta(path):
+    """Return file object of FASTA file, '-' is standard input and files ending with .gz are decompressed."""
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_fasta(lines):
+    """Return generator of records (id, sequence) from lines of a FASTA file.
+       Only one record is kept in memory, lines before the first header are skipped."""
+    name, chunks = None, []
+    for line in lines:
+        if line.startswith(FASTA_HEADER):
+            if name is not None:
+                yield name, ''.join(chunks)
+            fields = line[1:].split(None, 1)
+            name, chunks = fields[0] if fields else '', []
+        elif name is not None:
+            chunks.append(line.strip())
+    if name is not None:
+        yield name, ''.join(chunks)
+
+
+def read_pairs(paths, zipped=False):
+    """Return generator of pairs of records from FASTA files.
+       Consecutive records of all files (one after another) are paired, or with zipped=True
+       records of two files are paired by position."""
+    if zipped:
+        if len(paths) != 2:
+            raise ValueError('zipped pairs need exactly two FASTA files, got %d' % len(paths))
+        records_A, records_B = [read_fasta(open_fasta(path)) for path in paths]
+    else:
+        # files are opened one after another
+        records = itertools.chain.from_iterable(read_fasta(open_fasta(path)) for path in paths)
+        records_A = records_B = records
+    for record_A in records_A:
+        record_B = next(records_B, None)
+        if record_B is None:
+            raise ValueError('record %r has no pair' % record_A[0])
+        yield record_A, record_B
+    if zipped and next(records_B, None) is not None:
+        raise ValueError('second FASTA file has more records than the first one')
+
+
+def _align_chunk(sequence_pairs):
+    """Align a chunk of pairs in worker process, with arguments set by optimized_pairwise2._init_batch."""
+    return [optimized_pairwise2._align_pair((None, pair))[1] for pair in sequence_pairs]
+
+
+def align_pairs(pairs, mode, *args, **keywds):
+    """Align pairs of records (id, sequence) with alignment method mode, e.g. 'globalms'.
+
+       Yields tuples (recordA, recordB, result) in order of pairs. args and keywds are passed to the method as in
+       optimized_pairwise2.align_many, with keyword arguments workers (default: number of CPUs), chunksize
+       (pairs sent to a worker at once, default: 16) and max_in_flight (chunks sent to workers and not yet
+       written, default: 4 per worker). Pairs are read from the iterable only when there is room for them."""
+    workers = keywds.pop('workers', None) or multiprocessing.cpu_count()
+    chunksize = keywds.pop('chunksize', 16)
+    max_in_flight = keywds.pop('max_in_flight', None) or 4 * workers
+    keywds = optimized_pairwise2.align.alignment_function(mode).decode(None, None, *args, **keywds)
+    del keywds['sequenceA'], keywds['sequenceB']
+
+    pairs = iter(pairs)
+    chunks = iter(lambda: list(itertools.islice(pairs, chunksize)), [])
+    if workers == 1:
+        optimized_pairwise2._init_batch(keywds)
+        for chunk in chunks:
+            for (record_A, record_B), result in zip(chunk, _align_chunk([(a[1], b[1]) for a, b in chunk])):
+                yield record_A, record_B, result
+        return
+
+    pool = multiprocessing.Pool(workers, optimized_pairwise2._init_batch, (keywds,))
+    try:
+        # chunks of records with results computed by workers, in order of pairs
+        in_flight = collections.deque()
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                in_flight.append((chunk, pool.apply_async(_align_chunk, ([(a[1], b[1]) for a, b in chunk],))))
+            while in_flight and (chunk is None or len(in_flight) >= max_in_flight):
+                chunk_records, results = in_flight.popleft()
+                for (record_A, record_B), result in zip(chunk_records, results.get()):
+                    yield record_A, record_B, result
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+
+def format_tsv(index, record_A, record_B, result):
+    """Return TSV lines of result of aligning a pair, one line per alignment (or one line for score)."""
+    prefix = [str(index), record_A[0], record_B[0], str(len(record_A[1])), str(len(record_B[1]))]
+    if not isinstance(result, list):
+        return '\t'.join(prefix + [repr(result)]) + '\n'
+    if not result:
+        return '\t'.join(prefix) + '\n'
+    return ''.join('\t'.join(prefix + [repr(score), alignedA, alignedB, str(begin), str(end)]) + '\n'
+                   for alignedA, alignedB, score, begin, end in result)
+
+
+def format_jsonl(index, record_A, record_B, result):
+    """Return JSON line of result of aligning a pair."""
+    line = {'index': index, 'idA': record_A[0], 'idB': record_B[0],
+            'lengthA': len(record_A[1]), 'lengthB': len(record_B[1])}
+    if isinstance(result, list):
+        line['alignments'] = [dict(zip(ALIGNMENT_FIELDS, a)) for a in result]
+    else:
+        line['score'] = result
+    return json.dumps(line) + '\n'
+
+FORMATS = {'tsv': format_tsv, 'jsonl': format_jsonl}
+
+
+def peak_rss_kb():
+    """Return peak resident set size in kilobytes of this process and of its finished child processes."""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def run_pipeline(pairs, output, mode, args=(), output_format='tsv', **keywds):
+    """Align pairs of records and write results to output file object, return dictionary of statistics."""
+    format_result = FORMATS[output_format]
+    if output_format == 'tsv':
+        output.write('#' + '\t'.join(TSV_COLUMNS) + '\n')
+    start = timer()
+    count = residues = cells = 0
+    for index, (record_A, record_B, result) in enumerate(align_pairs(pairs, mode, *args, **keywds)):
+        output.write(format_result(index, record_A, record_B, result))
+        count += 1
+        residues += len(record_A[1]) + len(record_B[1])
+        cells += len(record_A[1]) * len(record_B[1])
+    output.flush()
+    seconds = timer() - start
+    rss, children_rss = peak_rss_kb()
+    return {'pairs': count, 'residues': residues, 'cells': cells, 'seconds': seconds,
+            'pairs_per_second': count / seconds if seconds else 0.0,
+            'cells_per_second': cells / seconds if seconds else 0.0,
+            'peak_rss_kb': rss, 'peak_workers_rss_kb': children_rss}
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog='python -m lib.align_pipeline', description=__doc__.split('\n')[0])
+    parser.add_argument('fasta', nargs='+', help="FASTA files ('-' for standard input, .gz files are decompressed)")
+    parser.add_argument('--zip', action='store_true', help='pair records of two files by position, '
+                                                           'instead of consecutive records')
+    parser.add_argument('--mode', default='globalxx', help='alignment method (default: globalxx)')
+    parser.add_argument('--params', type=float, nargs='*', default=[],
+                        help='numeric arguments of the method, e.g. scores and gap penalties of globalms')
+    parser.add_argument('--matrix', help='substitution matrix from Bio.SubsMat.MatrixInfo for methods '
+                                         'with dictionary match, e.g. blosum62')
+    parser.add_argument('--score-only', action='store_true', help='write only scores')
+    parser.add_argument('--all-alignments', action='store_true', help='write all optimal alignments '
+                                                                      '(default: one per pair)')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='tsv', help='output format (default: tsv)')
+    parser.add_argument('--output', '-o', default='-', help="output file (default: '-', standard output)")
+    parser.add_argument('--workers', type=int, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--chunksize', type=int, default=16, help='pairs sent to a worker at once (default: 16)')
+    parser.add_argument('--max-in-flight', type=int, help='chunks aligned and not yet written '
+                                                          '(default: 4 per worker)')
+    parser.add_argument('--engine', default='auto', help='score matrix engine (default: auto)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_arguments(argv)
+    args = list(options.params)
+    if options.matrix:
+        from Bio.SubsMat import MatrixInfo
+        args.insert(0, getattr(MatrixInfo, options.matrix))
+    keywds = {'workers': options.workers, 'chunksize': options.chunksize, 'max_in_flight': options.max_in_flight,
+              'engine': options.engine}
+    if options.score_only:
+        keywds['score_only'] = True
+    elif not options.all_alignments:
+        keywds['one_alignment_only'] = True
+
+    output = sys.stdout if options.output == '-' else open(options.output, 'wb')
+    try:
+        stats = run_pipeline(read_pairs(options.fasta, options.zip), output, options.mode, args,
+                             options.format, **keywds)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    sys.stderr.write('%(pairs)d pairs (%(residues)d residues) aligned in %(seconds).2f s: '
+                     '%(pairs_per_second).1f pairs/s, %(cells_per_second).3g cells/s\n'
+                     'peak RSS: %(peak_rss_kb)d kB, workers: %(peak_workers_rss_kb)d kB\n' % stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,436 @@
+"""Alignment service for event loops and servers: alignments are computed by a pool of processes,
+the calling thread only submits requests and gets results through callbacks.
+
+Requests are sent to workers in batches, the queue of waiting requests is bounded (submitting blocks
+or raises ServiceBusy when it is full, align_async and the HTTP server reject requests without blocking),
+and each request can be cancelled or given a timeout:
+
+    service = AlignmentService(workers=4)
+    request = service.submit('globalms', seqA, seqB, 2, -1, -.5, -.1, timeout=5.0)
+    request.add_done_callback(on_aligned)   # or request.result()
+
+An event loop keeps running while alignments are computed, e.g. with loop.call_soon_threadsafe in the
+callback. A small HTTP server (over TCP or a Unix socket) wraps the service for testing:
+
+Usage: python -m lib.align_service [--port PORT | --unix PATH] [--workers N]
+"""
+import argparse
+import BaseHTTPServer
+import collections
+import cPickle as pickle
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import SocketServer
+import sys
+import threading
+from timeit import default_timer as timer
+from . import optimized_pairwise2
+from .align_pipeline import ALIGNMENT_FIELDS
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ServiceBusy(Exception):
+    """Raised when a request is submitted without blocking while the queue of the service is full."""
+
+
+class AlignmentTimeout(Exception):
+    """Result of a request not computed before its timeout."""
+
+
+class AlignmentCancelled(Exception):
+    """Result of a cancelled request."""
+
+
+class AlignmentError(Exception):
+    """Result of a request, which result or error could not be sent back from worker process."""
+
+
+class AlignmentRequest(object):
+    """Alignment submitted to AlignmentService, its result is set by the service, like in futures."""
+
+    def __init__(self, keywds, deadline=None):
+        self.keywds = keywds
+        # arguments are sent to a worker pickled, errors of pickling them are raised here
+        self._arguments = pickle.dumps(keywds, pickle.HIGHEST_PROTOCOL)
+        self.deadline = deadline
+        self.submitted = timer()
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = self._exception = None
+        self._callbacks = []
+
+    def _set(self, result=None, exception=None):
+        """Set result or exception and call callbacks, return False if the request was already done."""
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._result, self._exception = result, exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+        return True
+
+    def _call(self, callback):
+        # callbacks run in threads of the service (e.g. result handler of the pool), which an error must not stop
+        try:
+            callback(self)
+        except Exception:
+            LOGGER.exception('exception calling callback of %r', self)
+
+    def cancel(self):
+        """Cancel the request, return False if it is already done. A batch which is being computed
+           is not stopped, but result of the request is not waited for."""
+        return self._set(exception=AlignmentCancelled())
+
+    def cancelled(self):
+        return isinstance(self._exception, AlignmentCancelled)
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        """Wait at most timeout seconds (without limit if None) for the request, return its exception or None."""
+        if not self._done.wait(timeout):
+            raise AlignmentTimeout('request not done in %r s' % timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        """Wait at most timeout seconds (without limit if None) for the request, return its result
+           or raise its exception."""
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def add_done_callback(self, callback):
+        """Call callback(request) when the request is done, in a thread of the service
+           (or in this thread, if it is already done). Exceptions of callback are logged and ignored."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+
+def _align_batch(batch_arguments):
+    """Align a batch of requests in worker process, return list of pickled tuples (result, exception).
+       Arguments and results are pickled for each request, so that an error (even of pickling a result)
+       fails only its request, and results of the batch are always sent back."""
+    results = []
+    for arguments in batch_arguments:
+        try:
+            outcome = (optimized_pairwise2._align(**pickle.loads(arguments)), None)
+        except Exception as e:
+            outcome = (None, e)
+        try:
+            results.append(pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            error = AlignmentError('result could not be sent from worker: %r' % e)
+            results.append(pickle.dumps((None, error), pickle.HIGHEST_PROTOCOL))
+    return results
+
+
+class AlignmentService(object):
+    """Computes alignments of submitted requests in a pool of workers processes (default: number of CPUs).
+       Requests are sent in batches of at most batch_size, a batch waits at most batch_delay seconds
+       for more requests. At most max_pending requests wait in queue and max_batches batches
+       (default: 2 per worker) are computed at once, so that requests do not pile up in the pool."""
+
+    def __init__(self, workers=None, batch_size=16, batch_delay=0.002, max_pending=1024, max_batches=None):
+        workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_pending = max_pending
+        self.max_batches = max_batches or 2 * workers
+        self.counters = dict.fromkeys(('submitted', 'completed', 'failed', 'cancelled', 'timed_out',
+                                       'rejected', 'batches'), 0)
+        self._pending = collections.deque()
+        self._deadlines = []
+        self._sequence = itertools.count()
+        # batches sent to workers by their numbers, so that close() fails requests of unfinished batches
+        self._batches = {}
+        self._closed = False
+        self._condition = threading.Condition()
+        self._pool = multiprocessing.Pool(workers)
+        self._dispatcher = threading.Thread(target=self._dispatch, name='AlignmentService dispatcher')
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, mode, sequenceA, sequenceB, *args, **keywds):
+        """Submit alignment of sequences with method mode, e.g. 'globalms', return AlignmentRequest.
+           args and keywds are passed to the method as in align.<mode>, except lazy and cache. Additional
+           keyword arguments:
+             timeout - seconds after which the request fails with AlignmentTimeout (default: no timeout)
+             block - if true (default), wait while the queue is full, otherwise raise ServiceBusy"""
+        timeout = keywds.pop('timeout', None)
+        block = keywds.pop('block', True)
+        if keywds.get('lazy') or keywds.get('cache') is not None:
+            raise ValueError('lazy alignments and caches are not supported by AlignmentService')
+        # errors of arguments (also of pickling them for workers, e.g. of lambda functions) are raised here
+        keywds = optimized_pairwise2.align.alignment_function(mode).decode(sequenceA, sequenceB, *args, **keywds)
+        request = AlignmentRequest(keywds, None if timeout is None else timer() + timeout)
+        with self._condition:
+            # callbacks of expired requests run in the dispatcher, which can not wait for itself to send batches
+            if threading.current_thread() is self._dispatcher:
+                block = False
+            while len(self._pending) >= self.max_pending and not self._closed:
+                if not block:
+                    self.counters['rejected'] += 1
+                    raise ServiceBusy('%d requests are waiting' % len(self._pending))
+                self._condition.wait()
+            if self._closed:
+                raise ValueError('AlignmentService is closed')
+            self._pending.append(request)
+            if request.deadline is not None:
+                heapq.heappush(self._deadlines, (request.deadline, next(self._sequence), request))
+            self.counters['submitted'] += 1
+            self._condition.notify_all()
+        return request
+
+    def align(self, mode, sequenceA, sequenceB, *args, **keywds):
+        """Submit alignment and wait for its result."""
+        return self.submit(mode, sequenceA, sequenceB, *args, **keywds).result()
+
+    def stats(self):
+        """Return dictionary of counters and current numbers of pending requests and batches in flight."""
+        with self._condition:
+            return dict(self.counters, pending=len(self._pending), batches_in_flight=len(self._batches))
+
+    def _dispatch(self):
+        """Send batches of pending requests to workers and fail requests after their deadlines, in a thread."""
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+                now = timer()
+                expired = self._expired(now)
+                if not expired:
+                    wait = None
+                    if self._deadlines:
+                        wait = self._deadlines[0][0] - now
+                    if self._pending and len(self._batches) < self.max_batches:
+                        # the first pending request waits at most batch_delay for more requests of its batch
+                        delay = self._pending[0].submitted + self.batch_delay - now
+                        if len(self._pending) >= self.batch_size or delay <= 0:
+                            self._send_batch()
+                            continue
+                        wait = delay if wait is None else min(wait, delay)
+                    self._condition.wait(wait)
+                    continue
+            # callbacks may submit requests, so they are not called while the lock is held
+            for request in expired:
+                if request._set(exception=AlignmentTimeout('request not done in time')):
+                    self._count('timed_out')
+
+    def _send_batch(self):
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            request = self._pending.popleft()
+            if not request.done():
+                batch.append(request)
+            elif request.cancelled():
+                self.counters['cancelled'] += 1
+        if batch:
+            number = next(self._sequence)
+            self._batches[number] = batch
+            self.counters['batches'] += 1
+            self._pool.apply_async(_align_batch, ([queued._arguments for queued in batch],),
+                                   callback=lambda results: self._finish_batch(number, results))
+        # there is room for submitted requests
+        self._condition.notify_all()
+
+    def _finish_batch(self, number, results):
+        """Set results of a batch, called in result handler thread of the pool."""
+        with self._condition:
+            batch = self._batches.pop(number, None)
+            self._condition.notify_all()
+        if batch is None:
+            # requests of the batch were cancelled by close()
+            return
+        for request, outcome in zip(batch, results):
+            try:
+                result, exception = pickle.loads(outcome)
+            except Exception as e:
+                # e.g. an exception class of a match function, which requires arguments
+                result, exception = None, AlignmentError('result could not be read from worker: %r' % e)
+            if request._set(result, exception):
+                self._count('completed' if exception is None else 'failed')
+            elif request.cancelled():
+                self._count('cancelled')
+
+    def _expired(self, now):
+        """Return requests after their deadlines, removing them from the heap of deadlines. Requests done
+           before their deadlines are removed too, so that they are not kept with their results until then."""
+        expired = []
+        while self._deadlines and (self._deadlines[0][0] <= now or self._deadlines[0][2].done()):
+            request = heapq.heappop(self._deadlines)[2]
+            if not request.done():
+                expired.append(request)
+        # requests not done yet are pending or in batches being computed, the heap is compacted
+        # when most of its requests are done
+        if len(self._deadlines) > 2 * (len(self._pending) + self.batch_size * len(self._batches)) + 64:
+            self._deadlines = [entry for entry in self._deadlines if not entry[2].done()]
+            heapq.heapify(self._deadlines)
+        return expired
+
+    def _count(self, counter):
+        with self._condition:
+            self.counters[counter] += 1
+
+    def close(self):
+        """Stop the workers, pending requests and requests of batches being computed are cancelled."""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            pending, self._pending = self._pending, collections.deque()
+            batches, self._batches = self._batches.values(), {}
+            self._condition.notify_all()
+        for request in itertools.chain(pending, *batches):
+            request.cancel()
+        self._pool.terminate()
+        self._dispatcher.join()
+
+
+_default_service = None
+_default_service_lock = threading.Lock()
+
+def align_async(mode, sequenceA, sequenceB, *args, **keywds):
+    """Submit alignment to a service shared by the process (created with default arguments when first used),
+       return AlignmentRequest. Arguments are as in AlignmentService.submit, except block: the calling thread
+       (e.g. of an event loop) never waits, if the queue is full the request is already failed with ServiceBusy."""
+    global _default_service
+    with _default_service_lock:
+        if _default_service is None:
+            _default_service = AlignmentService()
+    keywds['block'] = False
+    try:
+        return _default_service.submit(mode, sequenceA, sequenceB, *args, **keywds)
+    except ServiceBusy as e:
+        request = AlignmentRequest(None)
+        request._set(exception=e)
+        return request
+
+
+def result_as_json(result):
+    """Return JSON object of a score or list of alignments."""
+    if isinstance(result, list):
+        return {'alignments': [dict(zip(ALIGNMENT_FIELDS, alignment)) for alignment in result]}
+    return {'score': result}
+
+
+class AlignmentRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles POST /align with JSON object with keys mode, sequenceA, sequenceB and optional args
+       (list of numbers), matrix (name from Bio.SubsMat.MatrixInfo, inserted before args), keywds and timeout;
+       and GET /stats. Responds with JSON objects."""
+
+    def _respond(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._respond(404, {'error': 'unknown path %s' % self.path})
+        self._respond(200, self.server.service.stats())
+
+    def do_POST(self):
+        if self.path != '/align':
+            return self._respond(404, {'error': 'unknown path %s' % self.path})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            args = list(body.get('args', []))
+            if body.get('matrix'):
+                from Bio.SubsMat import MatrixInfo
+                args.insert(0, getattr(MatrixInfo, body['matrix']))
+            keywds = dict((str(k), v) for k, v in body.get('keywds', {}).iteritems())
+            request = self.server.service.submit(str(body['mode']), str(body['sequenceA']), str(body['sequenceB']),
+                                                 *args, timeout=body.get('timeout'), block=False, **keywds)
+        except ServiceBusy as e:
+            return self._respond(503, {'error': str(e)})
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return self._respond(400, {'error': repr(e)})
+        try:
+            result = request.result()
+        except AlignmentTimeout as e:
+            return self._respond(504, {'error': str(e)})
+        except Exception as e:
+            return self._respond(500, {'error': repr(e)})
+        self._respond(200, result_as_json(result))
+
+    def address_string(self):
+        # clients of Unix sockets have no address
+        return self.client_address[0] if self.client_address else self.server.server_address
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(address, service, verbose=False):
+    """Return HTTP server of service, listening on address: tuple (host, port) or path of Unix socket.
+       Requests are handled in threads, so that concurrent requests are batched."""
+    if isinstance(address, basestring):
+        if os.path.exists(address):
+            os.remove(address)
+        server = _ThreadingUnixHTTPServer(address, AlignmentRequestHandler)
+    else:
+        server = _ThreadingHTTPServer(address, AlignmentRequestHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog='python -m lib.align_service', description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1', help='address of HTTP server (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='port of HTTP server (default: 8080)')
+    parser.add_argument('--unix', help='path of Unix socket, used instead of host and port')
+    parser.add_argument('--workers', type=int, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--batch-size', type=int, default=16, help='requests sent to a worker at once '
+                                                                   '(default: 16)')
+    parser.add_argument('--max-pending', type=int, default=1024, help='requests waiting in queue, more are '
+                                                                      'rejected with status 503 (default: 1024)')
+    parser.add_argument('--verbose', '-v', action='store_true', help='log requests')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_arguments(argv)
+    address = options.unix or (options.host, options.port)
+    with AlignmentService(options.workers, options.batch_size, max_pending=options.max_pending) as service:
+        server = make_server(address, service, options.verbose)
+        sys.stderr.write('serving alignments on %s\n' % (address,))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+if __name__ == '__main__':
+    main()
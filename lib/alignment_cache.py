@@ -0,0 +1,177 @@
+"""Persistent cache of alignment results, keyed by a hash of sequences and decoded alignment arguments.
+
+Results are kept in a memory LRU tier and, optionally, in a SQLite file evicting least recently used results
+when it grows over a size limit. The cache is used by passing it to alignment methods:
+
+    cache = AlignmentCache('alignments.sqlite')
+    optimized_pairwise2.align.globalms(seqA, seqB, 2, -1, -.5, -.1, cache=cache)
+"""
+import collections
+import cPickle as pickle
+import hashlib
+import sqlite3
+import threading
+import time
+from . import lazy_import
+
+pairwise2 = lazy_import.LazyModule('Bio.pairwise2')
+
+# Arguments of _align which do not change results, only the way they are computed
+_RESULT_INDEPENDENT_ARGUMENTS = ('engine', 'checkpointed', 'band', 'spill')
+
+
+class _Uncacheable(Exception):
+    """Raised for arguments without stable description, e.g. user defined match functions."""
+
+
+def _describe(value):
+    """Return description of argument value, with a stable repr, or raise _Uncacheable."""
+    if isinstance(value, pairwise2.identity_match):
+        return 'identity_match', value.match, value.mismatch
+    if isinstance(value, pairwise2.dictionary_match):
+        return 'dictionary_match', sorted(value.score_dict.iteritems()), value.symmetric
+    if isinstance(value, pairwise2.affine_penalty):
+        return 'affine_penalty', value.open, value.extend, value.penalize_extend_when_opening
+    if callable(value):
+        raise _Uncacheable(value)
+    return value
+
+
+def alignment_key(keywds):
+    """Return hex digest identifying result of _align called with keywds, or None if it cannot be cached."""
+    if keywds.get('lazy'):
+        return None
+    keywds = dict(keywds)
+    for name in ('sequenceA', 'sequenceB'):
+        if not isinstance(keywds[name], list):
+            # e.g. repr of Seq object is shortened
+            keywds[name] = str(keywds[name])
+    try:
+        description = sorted((name, _describe(value)) for name, value in keywds.iteritems()
+                             if name not in _RESULT_INDEPENDENT_ARGUMENTS)
+    except _Uncacheable:
+        return None
+    return hashlib.sha1(repr(description)).hexdigest()
+
+
+class AlignmentCache(object):
+    """Cache of alignment results in memory (LRU of memory_items results) and optionally in SQLite file at path,
+       limited to about disk_bytes of pickled results. Counters memory_hits, disk_hits, misses and uncacheable
+       (calls with arguments which cannot be hashed, e.g. own match function) show how the cache is used.
+       When the file grows over disk_bytes, least recently used results are deleted down to evict_ratio of it."""
+
+    evict_ratio = 0.9
+
+    def __init__(self, path=None, memory_items=1024, disk_bytes=2 ** 30):
+        self.memory_items = memory_items
+        self.disk_bytes = disk_bytes
+        self.memory_hits = self.disk_hits = self.misses = self.uncacheable = 0
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS results '
+                             '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+            self._db.commit()
+        self._disk_total = self._disk_size()
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    def stats(self):
+        """Return dictionary of counters and sizes of cache tiers."""
+        return {'hits': self.hits, 'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses, 'uncacheable': self.uncacheable,
+                'memory_items': len(self._memory), 'disk_bytes': self._disk_size()}
+
+    def align(self, keywds, align_fn):
+        """Return result of align_fn(**keywds) from cache, or compute and store it."""
+        key = alignment_key(keywds)
+        if key is None:
+            with self._lock:
+                self.uncacheable += 1
+            return align_fn(**keywds)
+        value = self._get(key)
+        if value is not None:
+            return pickle.loads(value)
+        result = align_fn(**keywds)
+        self._put(key, pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        return result
+
+    def _get(self, key):
+        """Return pickled result of key or None, counting hits and misses."""
+        with self._lock:
+            value = self._memory.pop(key, None)
+            if value is not None:
+                self._memory[key] = value
+                self.memory_hits += 1
+                return value
+            if self._db is not None:
+                row = self._db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self._db.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+                    self._db.commit()
+                    self.disk_hits += 1
+                    value = str(row[0])
+                    self._remember(key, value)
+                    return value
+            self.misses += 1
+            return None
+
+    def _put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                # a result computed again (e.g. by another process) replaces the old row and its size
+                row = self._db.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+                self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                                 (key, sqlite3.Binary(value), len(value), time.time()))
+                self._disk_total += len(value) - (row[0] if row is not None else 0)
+                if self._disk_total > self.disk_bytes:
+                    self._evict()
+                self._db.commit()
+
+    def _remember(self, key, value):
+        """Put value in memory tier, dropping least recently used values."""
+        self._memory[key] = value
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _disk_size(self):
+        if self._db is None:
+            return 0
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+    def _evict(self):
+        """Delete least recently used results from disk tier until it fits in evict_ratio of disk_bytes."""
+        # other processes may share the file, so its size is read again
+        self._disk_total = self._disk_size()
+        excess = self._disk_total - int(self.disk_bytes * self.evict_ratio)
+        if excess <= 0:
+            return
+        rows = self._db.execute('SELECT key, size FROM results ORDER BY last_used')
+        evicted = []
+        for key, size in rows:
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+            self._disk_total -= size
+        self._db.executemany('DELETE FROM results WHERE key = ?', evicted)
+
+    def clear(self):
+        """Remove all results from both tiers, counters are not reset."""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM results')
+                self._db.commit()
+                self._disk_total = 0
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
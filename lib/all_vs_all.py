@@ -0,0 +1,276 @@
+"""All-vs-all alignment scores of many sequences, as a condensed matrix for clustering.
+
+Each pair of sequences i < j is aligned once, as the score of j with i is the same for symmetric scoring.
+Arguments, which may score swapped sequences differently (different gap penalties or end gaps of sequences A
+and B, asymmetric substitution matrices, own match or gap functions), are rejected.
+Only scores are computed, so matrices of long pairs are not kept in memory, by a pool of processes in chunks
+of consecutive pairs, short pairs of a chunk in batches as in optimized_pairwise2.score_many.
+The matrix is condensed as by scipy.spatial.distance.pdist (pair i < j of n sequences at index
+n * i - i * (i + 1) / 2 + j - i - 1), kept in memory or written to a memory-mapped .npy file:
+
+    matrix = all_vs_all(sequences, 'globalms', 2, -1, -.5, -.1, output='distances.npy', distance='normalized')
+
+Chunks written to the file are marked in a progress file next to it (OUTPUT.progress), so an interrupted run
+continues from them when started again with the same sequences and arguments, which are checked by a digest
+of them stored in the progress file. The progress file is removed at the end.
+
+Usage: python -m lib.all_vs_all [options] FASTA OUTPUT
+"""
+import argparse
+import hashlib
+import itertools
+import multiprocessing
+import os
+import sys
+from timeit import default_timer as timer
+import numpy as np
+from numpy.lib.format import open_memmap
+from . import alignment_cache
+from . import optimized_pairwise2
+from .align_pipeline import open_fasta, read_fasta
+
+PROGRESS_SUFFIX = '.progress'
+
+# Progress file starts with SHA-1 digest of sequences and arguments of the run, followed by flags of chunks
+RUN_KEY_SIZE = 20
+
+
+def condensed_size(n):
+    """Return number of pairs of n sequences."""
+    return n * (n - 1) // 2
+
+
+def condensed_index(n, i, j):
+    """Return index of pair i < j in condensed matrix of n sequences."""
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+def pair_of_index(n, index):
+    """Return pair (i, j) at given index of condensed matrix of n sequences."""
+    low, high = 0, n - 2
+    while low < high:
+        middle = (low + high + 1) // 2
+        if condensed_index(n, middle, middle + 1) <= index:
+            low = middle
+        else:
+            high = middle - 1
+    return low, index - condensed_index(n, low, low + 1) + low + 1
+
+
+def _pair_indexes(n, start, end):
+    """Return generator of pairs (i, j) at indexes from start to end of condensed matrix of n sequences."""
+    i, j = pair_of_index(n, start)
+    for _ in xrange(end - start):
+        yield i, j
+        j += 1
+        if j == n:
+            i += 1
+            j = i + 1
+
+
+def _as_array(scores):
+    """Return scores as float64 array, NaN for pairs without score (with an empty sequence or below min_score)."""
+    return np.array([np.nan if score is None or isinstance(score, list) else score for score in scores],
+                    dtype=np.float64)
+
+
+# Sequences and score function of all chunks, set in each worker process
+_sequences = None
+_score_pairs = None
+
+def _init_worker(sequences, keywds, score_pairs):
+    global _sequences, _score_pairs
+    _sequences, _score_pairs = sequences, score_pairs
+    optimized_pairwise2._init_batch(keywds)
+
+
+def _score_chunk(chunk):
+    """Return tuple (chunk, array of scores of its pairs) in worker process."""
+    _, start, end = chunk
+    sequences = _sequences
+    return chunk, _as_array(_score_pairs([(sequences[i], sequences[j])
+                                          for i, j in _pair_indexes(len(sequences), start, end)]))
+
+
+def is_symmetric(keywds):
+    """Return true, if alignment arguments (decoded, as in optimized_pairwise2._align) give the same score
+       of sequences A and B as of B and A."""
+    pairwise2 = optimized_pairwise2.pairwise2
+    gap_A_fn, gap_B_fn, match_fn = keywds['gap_A_fn'], keywds['gap_B_fn'], keywds['match_fn']
+    if keywds['penalize_end_gaps'][0] != keywds['penalize_end_gaps'][1]:
+        return False
+    if not isinstance(gap_A_fn, pairwise2.affine_penalty) or not isinstance(gap_B_fn, pairwise2.affine_penalty):
+        return False
+    if (gap_A_fn.open, gap_A_fn.extend) != (gap_B_fn.open, gap_B_fn.extend):
+        return False
+    if isinstance(match_fn, pairwise2.identity_match):
+        return True
+    if isinstance(match_fn, pairwise2.dictionary_match):
+        # a missing swapped pair is looked up as the pair itself only in symmetric dictionaries
+        score_dict = match_fn.score_dict
+        missing = score_dict.get if match_fn.symmetric else lambda pair: None
+        return all(score_dict.get(pair[::-1], missing(pair)) == score for pair, score in score_dict.iteritems())
+    return False
+
+
+def _run_key(sequences, keywds, chunk_size, distance):
+    """Return digest of sequences and arguments of a run, which scores in output depend on."""
+    digest = hashlib.sha1()
+    for sequence in sequences:
+        digest.update(repr(sequence if isinstance(sequence, list) else str(sequence)))
+    keywds = dict(keywds, sequenceA='', sequenceB='')
+    del keywds['batch_size']
+    if callable(distance):
+        distance = '%s.%s' % (getattr(distance, '__module__', None), getattr(distance, '__name__', None))
+    digest.update(repr((alignment_cache.alignment_key(keywds), chunk_size, distance)))
+    return digest.digest()
+
+
+def normalized_distance(scores, self_scores_A, self_scores_B):
+    """Return distances 1 - score / min(score of A with itself, score of B with itself),
+       0 for identical sequences and up to 1 (or more) for unrelated ones, if self scores are positive."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - scores / np.minimum(self_scores_A, self_scores_B)
+
+DISTANCES = {'normalized': normalized_distance}
+
+
+def _open_matrix(output, size, chunks, run_key):
+    """Return condensed matrix and array of flags of written chunks, as memory-mapped files if output is given.
+       Files of an interrupted run with the same run_key are opened again, otherwise new ones are created."""
+    if output is None:
+        return np.empty(size, dtype=np.float64), np.zeros(chunks, dtype=np.uint8)
+    progress_path = output + PROGRESS_SUFFIX
+    key = np.frombuffer(run_key, dtype=np.uint8)
+    if os.path.exists(output) and os.path.exists(progress_path):
+        matrix = open_memmap(output, mode='r+')
+        progress = open_memmap(progress_path, mode='r+')
+        if matrix.shape != (size,) or progress.shape != (RUN_KEY_SIZE + chunks,) or \
+                progress.dtype != np.uint8 or not np.array_equal(progress[:RUN_KEY_SIZE], key):
+            raise ValueError('%s was started with other sequences or arguments' % output)
+        return matrix, progress[RUN_KEY_SIZE:]
+    # progress is created first, so that an existing output without it is never mistaken for a resumed one
+    progress = open_memmap(progress_path, mode='w+', dtype=np.uint8, shape=(RUN_KEY_SIZE + chunks,))
+    progress[:RUN_KEY_SIZE] = key
+    progress.flush()
+    return open_memmap(output, mode='w+', dtype=np.float64, shape=(size,)), progress[RUN_KEY_SIZE:]
+
+
+def all_vs_all(sequences, mode, *args, **keywds):
+    """Return condensed matrix of scores (or distances) of all pairs of sequences, aligned with method mode.
+
+       mode is a name of alignment method, e.g. 'globalms', args and keywds are passed to it as in
+       optimized_pairwise2.score_many. Additional keyword arguments:
+         output - path of .npy file of the matrix, which is returned as numpy.memmap
+                  (default: None, matrix is an array in memory)
+         distance - None for scores (default), 'normalized' for normalized_distance or a function of arrays
+                    (scores, scores of the first sequences with themselves, of the second ones with themselves)
+         workers - number of processes (default: number of CPUs), with workers=1 pairs are aligned in this process
+         chunk_size - number of consecutive pairs aligned by a worker at once (default: 4096)
+         progress - function called with (pairs done, all pairs) after each chunk
+
+       Pairs with an empty sequence get NaN. Chunks are written in order of completion, a chunk is marked
+       as written only when it is flushed to output. Raises ValueError for arguments, which may give different
+       scores of swapped sequences (see is_symmetric), or if output was started with other sequences
+       or arguments."""
+    workers = keywds.pop('workers', None) or multiprocessing.cpu_count()
+    chunk_size = keywds.pop('chunk_size', 4096)
+    output = keywds.pop('output', None)
+    distance_name = keywds.pop('distance', None)
+    report_progress = keywds.pop('progress', None)
+    distance = DISTANCES.get(distance_name, distance_name)
+    sequences = list(sequences)
+    n, size = len(sequences), condensed_size(len(sequences))
+    chunks = [(index, start, min(start + chunk_size, size))
+              for index, start in enumerate(xrange(0, size, chunk_size))]
+    batch_keywds, score_pairs = optimized_pairwise2._score_arguments(mode, args, dict(keywds))
+    if not is_symmetric(batch_keywds):
+        raise ValueError('arguments of %s may score swapped sequences differently, '
+                         'scores of all pairs can not form a condensed matrix' % mode)
+    if distance is not None:
+        self_scores = _as_array(optimized_pairwise2.score_many(
+            [(sequence, sequence) for sequence in sequences], mode, *args, workers=workers, **keywds))
+
+    run_key = _run_key(sequences, batch_keywds, chunk_size, distance_name) if output is not None else None
+    matrix, written = _open_matrix(output, size, len(chunks), run_key)
+    pending = [chunk for chunk in chunks if not written[chunk[0]]]
+    done = size - sum(end - start for _, start, end in pending)
+    if workers == 1:
+        _init_worker(sequences, batch_keywds, score_pairs)
+        results = itertools.imap(_score_chunk, pending)
+    else:
+        pool = multiprocessing.Pool(workers, _init_worker, (sequences, batch_keywds, score_pairs))
+        results = pool.imap_unordered(_score_chunk, pending)
+    try:
+        for (index, start, end), scores in results:
+            if distance is not None:
+                rows, cols = np.array(list(_pair_indexes(n, start, end)), dtype=np.intp).reshape(-1, 2).T
+                scores = distance(scores, self_scores[rows], self_scores[cols])
+            matrix[start:end] = scores
+            if output is not None:
+                matrix.flush()
+            written[index] = True
+            if output is not None:
+                written.flush()
+            done += end - start
+            if report_progress is not None:
+                report_progress(done, size)
+        if workers != 1:
+            pool.close()
+            pool.join()
+    finally:
+        if workers != 1:
+            pool.terminate()
+    if output is not None:
+        del written
+        os.remove(output + PROGRESS_SUFFIX)
+    return matrix
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog='python -m lib.all_vs_all', description=__doc__.split('\n')[0])
+    parser.add_argument('fasta', help="FASTA file ('-' for standard input, .gz files are decompressed)")
+    parser.add_argument('output', help='.npy file of condensed matrix, identifiers of sequences are written '
+                                       'to OUTPUT.ids, one per line')
+    parser.add_argument('--mode', default='globalxx', help='alignment method (default: globalxx)')
+    parser.add_argument('--params', type=float, nargs='*', default=[],
+                        help='numeric arguments of the method, e.g. scores and gap penalties of globalms')
+    parser.add_argument('--matrix', help='substitution matrix from Bio.SubsMat.MatrixInfo for methods '
+                                         'with dictionary match, e.g. blosum62')
+    parser.add_argument('--distance', choices=sorted(DISTANCES), help='write distances instead of scores')
+    parser.add_argument('--workers', type=int, help='number of processes (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=4096,
+                        help='pairs aligned by a worker at once (default: 4096)')
+    parser.add_argument('--engine', default='auto', help='score matrix engine (default: auto)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_arguments(argv)
+    args = list(options.params)
+    if options.matrix:
+        from Bio.SubsMat import MatrixInfo
+        args.insert(0, getattr(MatrixInfo, options.matrix))
+    records = list(read_fasta(open_fasta(options.fasta)))
+    with open(options.output + '.ids', 'w') as ids:
+        ids.writelines(name + '\n' for name, _ in records)
+
+    start = timer()
+    resumed = []
+
+    def report_progress(done, size):
+        if not resumed:
+            resumed.append(done)
+        elapsed = timer() - start
+        rate = (done - resumed[0]) / elapsed if elapsed else 0.0
+        sys.stderr.write('\r%d/%d pairs (%.1f%%), %.1f pairs/s, %.0f s left ' % (
+            done, size, 100.0 * done / size, rate, (size - done) / rate if rate else 0.0))
+
+    all_vs_all([sequence for _, sequence in records], options.mode, *args, output=options.output,
+               distance=options.distance, workers=options.workers, chunk_size=options.chunk_size,
+               engine=options.engine, progress=report_progress)
+    sys.stderr.write('\n%d sequences aligned in %.2f s\n' % (len(records), timer() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Modules imported on first use, so that importing our code stays fast.
+
+NumPy alone takes most of the import time of optimized_pairwise2 and many alignments never use it:
+
+    numpy_engine = lazy_import.LazyModule('lib.numpy_engine')
+    numpy_engine.compute_score(...)  # lib.numpy_engine is imported here
+"""
+import imp
+import importlib
+import sys
+
+
+class LazyModule(object):
+    """Proxy of a module imported when any of its attributes is first read or set.
+       Functions and classes read through the proxy are kept in it, so that reading them again is fast."""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            module = self.__dict__['_module'] = importlib.import_module(self._name)
+        return module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        value = getattr(self._load(), attr)
+        if callable(value):
+            self.__dict__[attr] = value
+        return value
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+        self.__dict__.pop(attr, None)
+
+    def __repr__(self):
+        return '<lazy module %r%s>' % (self._name, '' if self.loaded else ' (not imported)')
+
+
+def module_available(name):
+    """Return whether top level module can be found, without importing it."""
+    if name in sys.modules:
+        return sys.modules[name] is not None
+    try:
+        module_file = imp.find_module(name)[0]
+    except ImportError:
+        return False
+    if module_file is not None:
+        module_file.close()
+    return True
@@ -0,0 +1,951 @@
+""" Vectorized score matrix engine for alignments with affine gap penalties.
+
+The matrices are filled along anti-diagonals (wavefront): every cell of one
+anti-diagonal depends only on the two previous anti-diagonals, so a whole
+anti-diagonal can be computed at once with NumPy. Arithmetic is done in the
+same order as in Bio.pairwise2._make_score_matrix_fast, so both score and
+trace matrices are exactly the same as the ones computed by Biopython.
+
+It is faster than Biopython only where Biopython calls a Python match function
+for every cell (dictionary_match, sequences as lists), e.g. globalds with
+blosum62 of two 1000 residues long proteins takes 0.3 s instead of 0.8 s.
+With identity_match on strings the C code of Biopython is as fast (globalxx
+of 1998 x 1735 nucleotides takes about 0.35 s with both), so there this engine
+is a memory optimization: its matrices are arrays instead of lists of floats.
+"""
+import copy
+import math
+import os
+import shutil
+import tempfile
+import numpy as np
+from Bio.pairwise2 import calc_affine_penalty
+
+# Score of cells outside of the band of banded alignment. Low enough to never be a part of the best alignment,
+# high enough to keep rint of it in int64 range.
+OUTSIDE_BAND = -1e15
+
+# With min_score, bounds of reachable scores are checked every SCORE_BOUND_INTERVAL anti-diagonals,
+# with a margin for errors of floating point arithmetic
+SCORE_BOUND_INTERVAL = 16
+SCORE_BOUND_MARGIN = 0.002
+
+# Number of strings with their encodings kept for reuse by following alignments, and bound of their total length
+# (a string and its codes take about 2 bytes per symbol). Longer strings are encoded again by every alignment,
+# so that sequences of long alignments are not kept in memory after them.
+ENCODED_STRINGS_CACHE_SIZE = 64
+ENCODED_STRINGS_CACHE_LENGTH = 2 ** 22
+
+
+def rint(values):
+    """ Vectorized version of Bio.pairwise2.rint """
+    return (values * 1000 + 0.5).astype(np.int64)
+
+
+def encode_sequence(sequence):
+    """ Encodes sequence as array of small integers (uint8 for alphabets of up to 256 symbols).
+        Returns tuple (codes, alphabet), where alphabet[codes[i]] == sequence[i].
+        Strings are encoded without Python loops, and encodings of recently used strings
+        (see ENCODED_STRINGS_CACHE_LENGTH) are reused, so their codes are read-only. """
+    global _encoded_strings_length
+    if isinstance(sequence, str):
+        encoded = _encoded_strings.get(sequence)
+        if encoded is None:
+            encoded = _encode_string(sequence)
+            if len(sequence) <= ENCODED_STRINGS_CACHE_LENGTH:
+                if len(_encoded_strings) >= ENCODED_STRINGS_CACHE_SIZE or \
+                        _encoded_strings_length + len(sequence) > ENCODED_STRINGS_CACHE_LENGTH:
+                    _encoded_strings.clear()
+                    _encoded_strings_length = 0
+                _encoded_strings[sequence] = encoded
+                _encoded_strings_length += len(sequence)
+        return encoded
+    symbols = {}
+    codes = np.fromiter((symbols.setdefault(s, len(symbols)) for s in sequence), np.intp, len(sequence))
+    alphabet = [None] * len(symbols)
+    for s, code in symbols.iteritems():
+        alphabet[code] = s
+    return codes.astype(_codes_type(len(alphabet))), alphabet
+
+
+def _codes_type(alphabet_size):
+    """ Returns the smallest integer type for codes of symbols of an alphabet """
+    return np.uint8 if alphabet_size <= 256 else np.uint16 if alphabet_size <= 2 ** 16 else np.intp
+
+
+def _encode_string(sequence):
+    """ Returns tuple (codes, alphabet) of a string, with symbols of alphabet in order of their byte values """
+    raw = np.frombuffer(sequence, dtype=np.uint8)
+    symbols = np.flatnonzero(np.bincount(raw, minlength=256))
+    lookup = np.zeros(256, dtype=np.uint8)
+    lookup[symbols] = np.arange(len(symbols))
+    codes = lookup[raw]
+    codes.flags.writeable = False
+    return codes, [chr(symbol) for symbol in symbols]
+
+# Encodings of recently used strings and their total length, cleared when full
+_encoded_strings = {}
+_encoded_strings_length = 0
+
+
+def is_integral(values):
+    """ Returns true, if all given values are integers """
+    return np.all(np.floor(values) == values)
+
+
+def score_type(wavefront):
+    """ Returns type of stored scores: int32 for integer scores, if no reachable score overflows it
+        (each of at most lenA + lenB steps of an alignment adds a match score or a gap penalty),
+        float64 otherwise """
+    if not wavefront.integral:
+        return np.float64
+    codesA, codesB = wavefront.sequence_codes
+    step = max(np.abs(wavefront.scores).max() if len(wavefront.scores) else 0.0,
+               abs(wavefront.first_A_gap), abs(wavefront.extend_A), abs(wavefront.first_B_gap), abs(wavefront.extend_B))
+    return np.int32 if step * (len(codesA) + len(codesB)) < 2 ** 31 else np.float64
+
+
+def match_table(alphabetA, alphabetB, match_fn):
+    """ Returns matrix of match scores between every symbol of alphabetA and every symbol of alphabetB """
+    return np.array([[match_fn(a, b) for b in alphabetB] for a in alphabetA], dtype=np.float64)
+
+
+def make_score_matrix(sequenceA, sequenceB, match_fn, open_A, extend_A,
+                      open_B, extend_B, penalize_extend_when_opening,
+                      penalize_end_gaps, align_globally, score_only):
+    """ Generate a score and traceback matrix according to Gotoh.
+        Takes the same arguments as Bio.pairwise2._make_score_matrix_fast and returns same matrices. """
+    lenA, lenB = len(sequenceA), len(sequenceB)
+    wavefront = Wavefront(sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+                          penalize_extend_when_opening, penalize_end_gaps, align_globally,
+                          with_trace=not score_only)
+    # Integer scores are stored exactly in 4 bytes (unless they might overflow), trace bits fit in 1 byte
+    score_matrix = np.empty((lenA + 1, lenB + 1), dtype=score_type(wavefront))
+    trace_matrix = None if score_only else np.zeros((lenA + 1, lenB + 1), dtype=np.uint8)
+    _fill_matrices(wavefront, score_matrix, trace_matrix)
+    if score_only:
+        return MatrixRows(score_matrix), [None]
+    return MatrixRows(score_matrix), MatrixRows(trace_matrix)
+
+
+class MatrixRows(list):
+    """ List of rows of 2D array, so that matrix[row][col] works as for nested lists of Bio.pairwise2.
+        Rows are views, so changes are written to the array, which is available as attribute array. """
+
+    def __init__(self, array):
+        list.__init__(self, array)
+        self.array = array
+
+
+def find_starts(score_matrix, align_globally):
+    """ Returns tuple (best score, starts) for given score array, where starts are tuples (score, (row, col))
+        in row-major order. Global alignments start in the bottom right cell, local alignments in cells
+        with the best score (within rint precision, as in Bio.pairwise2). """
+    if align_globally:
+        best_score = float(score_matrix[-1, -1])
+        return best_score, [(best_score, (score_matrix.shape[0] - 1, score_matrix.shape[1] - 1))]
+    best_score = score_matrix.max()
+    rows, cols = np.nonzero(score_matrix > best_score - 0.001)
+    scores = score_matrix[rows, cols].astype(np.float64)
+    close = rint(np.abs(scores - best_score)) <= 0
+    return float(best_score), [(score, (row, col)) for score, row, col in
+                               zip(scores[close].tolist(), rows[close].tolist(), cols[close].tolist())]
+
+
+def compute_score(sequenceA, sequenceB, match_fn, open_A, extend_A,
+                  open_B, extend_B, penalize_extend_when_opening,
+                  penalize_end_gaps, align_globally, profile=None, min_score=None, xdrop=None):
+    """ Return score of the best alignment without making score matrix.
+        Uses memory linear to the length of the shorter sequence.
+        Match scores are taken from profile, if QueryProfile of sequenceA is given.
+        With min_score, None is returned as soon as no alignment can reach it.
+        With xdrop (local alignments only), computation stops when all cells of the last anti-diagonals
+        are lower than the best score by more than xdrop, and the best score found so far is returned. """
+    if profile is not None:
+        codesA = profile.codes
+        codesB, alphabetB = encode_sequence(sequenceB)
+        table = profile.table(alphabetB)
+    else:
+        codesA, alphabetA = encode_sequence(sequenceA)
+        codesB, alphabetB = encode_sequence(sequenceB)
+        table = match_table(alphabetA, alphabetB, match_fn)
+    if len(sequenceB) < len(sequenceA):
+        # Alignment of swapped sequences has the same scores in transposed matrix.
+        sequenceA, sequenceB = sequenceB, sequenceA
+        match_fn = _swapped_arguments(match_fn)
+        open_A, extend_A, open_B, extend_B = open_B, extend_B, open_A, extend_A
+        penalize_end_gaps = penalize_end_gaps[::-1]
+        codesA, codesB, table = codesB, codesA, table.T
+    wavefront = Wavefront(sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+                          penalize_extend_when_opening, penalize_end_gaps, align_globally,
+                          encoded=(codesA, codesB, table))
+    # Bounds of scores reachable from computed cells are known only if gaps never increase scores
+    bounded = min_score is not None and max(open_A, extend_A, open_B, extend_B) <= 0
+    if bounded:
+        suffix_bounds = (_suffix_match_bounds(codesA, table.max(axis=1)),
+                         _suffix_match_bounds(codesB, table.max(axis=0)))
+    best_score = max(wavefront.first_col.max(), wavefront.first_row.max())
+    previous_max = best_score
+    for d, _, _, scores, _ in wavefront:
+        diagonal_max = scores.max()
+        best_score = max(best_score, diagonal_max)
+        if xdrop is not None and max(diagonal_max, previous_max) < best_score - xdrop:
+            break
+        previous_max = diagonal_max
+        if not bounded or d % SCORE_BOUND_INTERVAL or (not align_globally and best_score >= min_score):
+            continue
+        if max(best_score, _score_bound(wavefront, *suffix_bounds)) < min_score - SCORE_BOUND_MARGIN:
+            return None
+    if align_globally:
+        best_score = scores[-1]
+    if min_score is not None and best_score < min_score:
+        return None
+    return float(best_score)
+
+
+def compute_scores(pairs, match_fn, open_A, extend_A, open_B, extend_B, penalize_extend_when_opening,
+                   penalize_end_gaps, align_globally):
+    """ Returns list of scores of the best alignments of many pairs of non-empty strings, same as compute_score.
+        Sequences are padded to the longest ones and anti-diagonals of matrices of all pairs are computed at once,
+        in arrays with a row per pair, so that the cost of Python code is shared by the whole batch.
+        Cells outside of a pair's matrix are computed too, but never read by cells of the matrix.
+        Padding symbols match anything with score OUTSIDE_BAND, so that (as gaps never increase scores)
+        cells outside of the matrix are not higher than the best local alignment in it.
+        Positive gap penalties are rejected with ValueError, as by Bio.pairwise2.affine_penalty. """
+    if max(open_A, extend_A, open_B, extend_B) > 0:
+        raise ValueError('Gap penalties should be non-positive.')
+    count = len(pairs)
+    lensA = np.array([len(sequenceA) for sequenceA, _ in pairs], dtype=np.intp)
+    lensB = np.array([len(sequenceB) for _, sequenceB in pairs], dtype=np.intp)
+    lenA, lenB = lensA.max(), lensB.max()
+
+    # All sequences are encoded with one alphabet. B is reversed, as in Wavefront, after padding at its end.
+    sequences = [sequenceA for sequenceA, _ in pairs] + [sequenceB for _, sequenceB in pairs]
+    raw = np.frombuffer(''.join(sequences), dtype=np.uint8)
+    symbols = np.flatnonzero(np.bincount(raw, minlength=256))
+    lookup = np.zeros(256, dtype=np.intp)
+    lookup[symbols] = np.arange(len(symbols))
+    alphabet = [chr(symbol) for symbol in symbols]
+    padding = len(alphabet)
+    table = np.full((padding + 1, padding + 1), OUTSIDE_BAND)
+    table[:padding, :padding] = match_table(alphabet, alphabet, match_fn)
+    match_scores_table = table.ravel()
+    codes = lookup[raw]
+    codesA = np.full((count, lenA), padding, dtype=np.intp)
+    codesB = np.full((count, lenB), padding, dtype=np.intp)
+    offset = 0
+    for k, length in enumerate(np.concatenate([lensA, lensB]).tolist()):
+        padded = codesA[k] if k < count else codesB[k - count]
+        padded[:length] = codes[offset:offset + length]
+        offset += length
+    codesA *= padding + 1
+    codesB = codesB[:, ::-1].copy()
+
+    pe = penalize_extend_when_opening
+    open_A, extend_A = float(open_A), float(extend_A)
+    open_B, extend_B = float(open_B), float(extend_B)
+    first_A_gap = calc_affine_penalty(1, open_A, extend_A, pe)
+    first_B_gap = calc_affine_penalty(1, open_B, extend_B, pe)
+    first_col = np.zeros(lenA + 1, dtype=np.float64)
+    first_row = np.zeros(lenB + 1, dtype=np.float64)
+    if penalize_end_gaps[1]:
+        first_col[:] = [calc_affine_penalty(i, open_B, extend_B, pe) for i in xrange(lenA + 1)]
+    if penalize_end_gaps[0]:
+        first_row[:] = [calc_affine_penalty(i, open_A, extend_A, pe) for i in xrange(lenB + 1)]
+    col_init = [calc_affine_penalty(i, 2 * open_B, extend_B, pe) for i in xrange(lenB + 1)]
+
+    # Same buffers as in Wavefront, with a row per pair
+    diagonals = [np.empty((count, lenA + 1), dtype=np.float64) for _ in xrange(3)]
+    diagonals[1][:, 0] = first_row[0]
+    diagonals[0][:, 0] = first_row[1]
+    diagonals[0][:, 1] = first_col[1]
+    row_cache = np.tile([calc_affine_penalty(i, 2 * open_A, extend_A, pe) for i in xrange(lenA + 1)], (count, 1))
+    col_cache = np.zeros((count, lenA + 1), dtype=np.float64)
+
+    # Without penalties of end gaps, gaps in the last row (column) of a pair's matrix cost nothing.
+    # Per pair penalties of rows and of columns (reversed, as B) are added, so that x + 0.0 == x is kept.
+    rows = np.arange(lenA + 1)
+    first_A_gaps = np.full((count, lenA + 1), first_A_gap)
+    extends_A = np.full((count, lenA + 1), extend_A)
+    if not penalize_end_gaps[0]:
+        last_rows = rows == lensA[:, np.newaxis]
+        first_A_gaps[last_rows] = extends_A[last_rows] = 0.0
+    first_B_gaps = np.full((count, lenB + 1), first_B_gap)
+    extends_B = np.full((count, lenB + 1), extend_B)
+    if not penalize_end_gaps[1]:
+        last_cols = np.arange(lenB, -1, -1) == lensB[:, np.newaxis]
+        first_B_gaps[last_cols] = extends_B[last_cols] = 0.0
+    if align_globally:
+        # Pairs ending on each anti-diagonal
+        ends = {}
+        for k, d in enumerate((lensA + lensB).tolist()):
+            ends.setdefault(d, []).append(k)
+    else:
+        best_scores = np.maximum(np.maximum.accumulate(first_col)[lensA], np.maximum.accumulate(first_row)[lensB])
+    scores = np.empty(count)
+    for d in xrange(2, lenA + lenB + 1):
+        lo, hi = max(1, d - lenB), min(lenA, d - 1)
+        diagonals.insert(0, diagonals.pop())
+        current, previous, before_previous = diagonals
+        if d <= lenA:
+            current[:, d] = first_col[d]
+        if d <= lenB:
+            current[:, 0] = first_row[d]
+        if d - 1 <= lenB:
+            col_cache[:, 0] = col_init[d - 1]
+
+        match_scores = match_scores_table[codesA[:, lo - 1:hi] + codesB[:, lenB - d + lo:lenB - d + hi + 1]]
+        nogap_score = before_previous[:, lo - 1:hi] + match_scores
+
+        row_score = np.maximum(previous[:, lo:hi + 1] + first_A_gaps[:, lo:hi + 1],
+                               row_cache[:, lo:hi + 1] + extends_A[:, lo:hi + 1])
+        cols = slice(lenB - d + lo, lenB - d + hi + 1)
+        col_score = np.maximum(previous[:, lo - 1:hi] + first_B_gaps[:, cols],
+                               col_cache[:, lo - 1:hi] + extends_B[:, cols])
+
+        best_score = np.maximum(np.maximum(row_score, col_score), nogap_score)
+        diagonal_scores = current[:, lo:hi + 1]
+        if align_globally:
+            diagonal_scores[:] = best_score
+            ending = ends.get(d)
+            if ending is not None:
+                scores[ending] = current[ending, lensA[ending]]
+        else:
+            np.maximum(best_score, 0, out=diagonal_scores)
+            np.maximum(best_scores, diagonal_scores.max(axis=1), out=best_scores)
+        row_cache[:, lo:hi + 1] = row_score
+        col_cache[:, lo:hi + 1] = col_score
+    if not align_globally:
+        scores = best_scores
+    return scores.tolist()
+
+
+def _suffix_match_bounds(codes, max_scores):
+    """ Returns array of len(codes) + 1 sums: bounds[i] = sum of positive max match scores of symbols codes[i:] """
+    positive = np.maximum(max_scores, 0)[codes]
+    return np.concatenate([np.cumsum(positive[::-1])[::-1], [0.0]])
+
+
+def _score_bound(wavefront, suffix_A, suffix_B):
+    """ Returns upper bound of scores of alignments going through cells not computed yet by wavefront,
+        assuming that gaps do not increase scores. Every such alignment passes through one of the last
+        two anti-diagonals (or, if local, starts after them, as if from a cell of score 0 on them),
+        and each of its next matches pairs a different symbol of the rest of sequence A and of sequence B. """
+    lenA, lenB = wavefront.lenA, wavefront.lenB
+    bound = -np.inf
+    for k in (0, 1):
+        d = wavefront.d - k
+        lo, hi = max(0, d - lenB), min(lenA, d)
+        rows = np.arange(lo, hi + 1)
+        remaining = np.minimum(suffix_A[rows], suffix_B[d - rows])
+        scores = wavefront.diagonals[k][lo:hi + 1]
+        if not wavefront.align_globally:
+            scores = np.maximum(scores, 0)
+        bound = max(bound, (scores + remaining).max())
+    return bound
+
+
+class QueryProfile(object):
+    """ Query sequence encoded once for aligning it with many target sequences.
+        Match scores of query symbols with a target symbol are computed once, when the symbol is first seen. """
+
+    def __init__(self, query, match_fn):
+        self.codes, self.alphabet = encode_sequence(query)
+        self.match_fn = match_fn
+        self.columns = {}
+
+    def table(self, alphabet):
+        """ Returns match_table(query alphabet, alphabet, match_fn) """
+        columns = self.columns
+        for symbol in alphabet:
+            if symbol not in columns:
+                columns[symbol] = [self.match_fn(a, symbol) for a in self.alphabet]
+        return np.array([columns[symbol] for symbol in alphabet], dtype=np.float64).T.reshape(
+            len(self.alphabet), len(alphabet))
+
+
+def _swapped_arguments(match_fn):
+    """ Returns match function taking characters in reversed order """
+    return lambda charB, charA: match_fn(charA, charB)
+
+
+def _fill_matrices(wavefront, score_matrix, trace_matrix=None):
+    """ Writes all values computed by wavefront to given matrices """
+    lenB = wavefront.lenB
+    score_matrix[:, 0] = wavefront.first_col
+    score_matrix[0, :] = wavefront.first_row
+    # Flat views: cells (i, d - i) of anti-diagonal d form a slice with step lenB
+    score_flat = score_matrix.ravel()
+    if trace_matrix is not None:
+        trace_flat = trace_matrix.ravel()
+    for d, lo, hi, scores, trace in wavefront:
+        cells = slice(lo * lenB + d, hi * lenB + d + 1, lenB)
+        score_flat[cells] = scores
+        if trace_matrix is not None:
+            trace_flat[cells] = trace
+
+
+class Wavefront(object):
+    """ Computes score and trace matrices anti-diagonal by anti-diagonal.
+        Only the last anti-diagonals are kept in memory, iterating over this object
+        yields tuples (d, lo, hi, scores, trace) with values of cells (i, d - i) for i in [lo, hi].
+        Trace is None, unless with_trace is set. Yielded arrays are valid only until next iteration.
+        Already encoded sequences can be given as tuple encoded = (codesA, codesB, match table).
+        With band = (min offset, max offset), only cells (row, col) with min offset <= col - row <= max offset
+        are computed, as if cells outside of the band were never a part of an alignment. """
+
+    def __init__(self, sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+                 penalize_extend_when_opening, penalize_end_gaps, align_globally, with_trace=False, encoded=None,
+                 band=None):
+        lenA, lenB = len(sequenceA), len(sequenceB)
+        pe = penalize_extend_when_opening
+        open_A, extend_A = float(open_A), float(extend_A)
+        open_B, extend_B = float(open_B), float(extend_B)
+        self.extend_A, self.extend_B = extend_A, extend_B
+        self.first_A_gap = calc_affine_penalty(1, open_A, extend_A, pe)
+        self.first_B_gap = calc_affine_penalty(1, open_B, extend_B, pe)
+        self.penalize_end_gaps = penalize_end_gaps
+        self.align_globally = align_globally
+        self.with_trace = with_trace
+        self.band = band
+
+        # Match score of cell (row, col) is scores[codesA[row - 1] * len(alphabetB) + codesB[col - 1]]
+        if encoded is None:
+            codesA, alphabetA = encode_sequence(sequenceA)
+            codesB, alphabetB = encode_sequence(sequenceB)
+            table = match_table(alphabetA, alphabetB, match_fn)
+        else:
+            codesA, codesB, table = encoded
+        self.scores = table.ravel()
+        self.sequence_codes = codesA.astype(np.intp) * table.shape[1], codesB
+
+        # When all scores are integers, rint(x) == rint(y) is the same as x == y
+        self.integral = is_integral(self.scores) and all(is_integral(x) for x in (open_A, extend_A, open_B, extend_B))
+        if self.integral:
+            self.rint = lambda x: x
+        else:
+            self.rint = rint
+
+        # First row and column hold gap scores. This is like opening up i gaps at the beginning of sequence A or B.
+        first_col = np.zeros(lenA + 1, dtype=np.float64)
+        first_row = np.zeros(lenB + 1, dtype=np.float64)
+        if penalize_end_gaps[1]:
+            first_col[:] = [calc_affine_penalty(i, open_B, extend_B, pe) for i in xrange(lenA + 1)]
+        if penalize_end_gaps[0]:
+            first_row[:] = [calc_affine_penalty(i, open_A, extend_A, pe) for i in xrange(lenB + 1)]
+        # Initial values of row and col caches (see _start)
+        self.row_init = np.array([calc_affine_penalty(i, 2 * open_A, extend_A, pe) for i in xrange(lenA + 1)])
+        self.col_init = np.array([calc_affine_penalty(i, 2 * open_B, extend_B, pe) for i in xrange(lenB + 1)])
+        self._start(0, lenA, 0, lenB, first_row, first_col, self.row_init, self.col_init)
+
+    def block(self, row_start, row_end, col_start, col_end, top_scores, top_col_cache, left_scores, left_row_cache):
+        """ Returns wavefront computing only cells (row, col) with row_start < row <= row_end and
+            col_start < col <= col_end. Block is aligned as a whole matrix, with its first row and column given:
+            scores and col cache of row row_start, and scores and row cache of column col_start. """
+        block = copy.copy(self)
+        block._start(row_start, row_end, col_start, col_end, top_scores, left_scores, left_row_cache, top_col_cache)
+        return block
+
+    def _start(self, row_start, row_end, col_start, col_end, first_row, first_col, row_init, col_init):
+        """ Prepares computation of given block of matrices """
+        all_codesA, all_codesB = self.sequence_codes
+        # End gaps are special only in the last row and column of the whole matrix
+        self.ends_matrix = (row_end == len(all_codesA), col_end == len(all_codesB))
+        self.lenA = lenA = row_end - row_start
+        self.lenB = col_end - col_start
+        # Sequence B is reversed, so that cells of an anti-diagonal use a contiguous slice of it.
+        self.codesA = all_codesA[row_start:row_end]
+        self.codesB = all_codesB[col_start:col_end][::-1].copy()
+        self.first_row, self.first_col = first_row, first_col
+
+        # Scores of the current and two previous anti-diagonals, indexed by row number:
+        # diagonals[k][i] = score_matrix[i][d - k - i]. Buffers are rotated at each step.
+        self.diagonals = [np.empty(lenA + 1, dtype=np.float64) for _ in xrange(3)]
+        self.diagonals[1][0] = first_row[0]
+        self.diagonals[0][0] = first_row[1]
+        self.diagonals[0][1] = first_col[1]
+        self.d = 1
+
+        # Row and col caches, indexed by row number, holding values from the previous anti-diagonal.
+        # row_cache[i] = best score of alignment ending with gap in seqA at cell (i, d - 1 - i)
+        # col_cache[i] = best score of alignment ending with gap in seqB at cell (i, d - 1 - i)
+        # Row cache is initialized with values of column 0, col cache gets values of row 0 during computation.
+        self.row_cache = np.array(row_init, dtype=np.float64)
+        self.col_cache = np.zeros(lenA + 1, dtype=np.float64)
+        self.col_init = col_init
+
+    def __iter__(self):
+        while self.d < self.lenA + self.lenB:
+            yield self.advance()
+
+    def advance(self):
+        """ Computes the next anti-diagonal """
+        lenA, lenB = self.lenA, self.lenB
+        row_cache, col_cache = self.row_cache, self.col_cache
+        self.d = d = self.d + 1
+        lo, hi = max(1, d - lenB), min(lenA, d - 1)
+        if self.band is not None:
+            lo, hi = max(lo, (d - self.band[1] + 1) // 2), min(hi, (d - self.band[0]) // 2)
+        self.diagonals.insert(0, self.diagonals.pop())
+        current, previous, before_previous = self.diagonals
+        # values in column 0 and row 0 come from initialization
+        if d <= lenA:
+            current[d] = self.first_col[d]
+        if d <= lenB:
+            current[0] = self.first_row[d]
+        if d - 1 <= lenB:
+            col_cache[0] = self.col_init[d - 1]
+
+        match_scores = self.scores[self.codesA[lo - 1:hi] + self.codesB[lenB - d + lo:lenB - d + hi + 1]]
+        nogap_score = before_previous[lo - 1:hi] + match_scores
+
+        row_open = previous[lo:hi + 1] + self.first_A_gap
+        row_extend = row_cache[lo:hi + 1] + self.extend_A
+        if not self.penalize_end_gaps[0] and hi == lenA and self.ends_matrix[0]:
+            row_open[-1] = previous[hi]
+            row_extend[-1] = row_cache[hi]
+        row_score = np.maximum(row_open, row_extend)
+
+        col_open = previous[lo - 1:hi] + self.first_B_gap
+        col_extend = col_cache[lo - 1:hi] + self.extend_B
+        if not self.penalize_end_gaps[1] and lo == d - lenB and self.ends_matrix[1]:
+            col_open[0] = previous[lo - 1]
+            col_extend[0] = col_cache[lo - 1]
+        col_score = np.maximum(col_open, col_extend)
+
+        best_score = np.maximum(np.maximum(row_score, col_score), nogap_score)
+        scores = current[lo:hi + 1]
+        if self.align_globally:
+            scores[:] = best_score
+        else:
+            np.maximum(best_score, 0, out=scores)
+
+        # The trace is encoded binary, the same way as in Bio.pairwise2
+        trace = None
+        if self.with_trace:
+            rint = self.rint
+            row_score_rint = rint(row_score)
+            col_score_rint = rint(col_score)
+            best_score_rint = rint(best_score)
+            row_trace = (rint(row_open) == row_score_rint) * 1 + (rint(row_extend) == row_score_rint) * 8
+            col_trace = (rint(col_open) == col_score_rint) * 4 + (rint(col_extend) == col_score_rint) * 16
+            trace = (rint(nogap_score) == best_score_rint) * 2 + \
+                    (row_score_rint == best_score_rint) * row_trace + \
+                    (col_score_rint == best_score_rint) * col_trace
+
+        # Row cache keeps its initial value in column 0.
+        row_cache[lo:hi + 1] = row_score
+        col_cache[lo:hi + 1] = col_score
+        if self.band is not None:
+            # Neighbours of the band, read when computing the next anti-diagonal
+            for row in (lo - 1, hi + 1):
+                if 1 <= row <= lenA and 1 <= d - row <= lenB:
+                    current[row] = row_cache[row] = col_cache[row] = OUTSIDE_BAND
+        return d, lo, hi, scores, trace
+
+
+class CheckpointedMatrices(object):
+    """ Score and trace matrices, which do not have to fit in memory.
+        Matrices are computed once, saving scores and gap caches of every k-th row and column (checkpoints).
+        Later, accessed cells are recomputed from the nearest checkpoint, in bands of k rows or k columns.
+        Band of rows is used for traceback going left or diagonally, band of columns when going up a column.
+        Traceback never goes right or down, so bands are computed only up to the accessed cell.
+        Memory usage is O((lenA + lenB) * sqrt(min(lenA, lenB))) instead of O(lenA * lenB), not linear:
+        checkpoints take 32 * lenA * lenB / k bytes and cached bands up to 9 * cached_bands * k * max(lenA, lenB)
+        bytes, with k chosen to balance both and bands at least min_band thick, so that NumPy operations
+        are done on long enough anti-diagonals. E.g. 50k x 50k matrices take about 1.1 GB (instead of 12 GB
+        of arrays of make_score_matrix), but 1M x 1M matrices still take about 80 GB. This is a reduction of memory
+        for sequences of tens of thousands of symbols, not a linear space traceback (as Hirschberg's algorithm),
+        so it does not make genome-scale alignments fit in memory; matrices of such alignments can be
+        kept on disk by SpilledMatrices.
+
+        Attributes score_matrix and trace_matrix support matrix[row][col] access as in Bio.pairwise2,
+        best_score is the highest score in the matrix and local_starts are cells scoring the same
+        (within rint precision), as (score, (row, col)) tuples (only for local alignments).
+        last_score is score of the bottom right cell.
+    """
+    cached_bands = 4
+    min_band = 512
+
+    def __init__(self, sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+                 penalize_extend_when_opening, penalize_end_gaps, align_globally):
+        self.wavefront = wavefront = Wavefront(sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+                                               penalize_extend_when_opening, penalize_end_gaps, align_globally)
+        lenA, lenB = wavefront.lenA, wavefront.lenB
+        # balances memory used by checkpoints (16 bytes per cell) and cached bands (9 bytes per cell)
+        self.k = k = max(int(math.sqrt(16.0 * lenA * lenB / (9 * self.cached_bands * (lenA + lenB)))) + 1,
+                         self.min_band)
+        checkpoint_rows, checkpoint_cols = np.arange(k, lenA, k), np.arange(k, lenB, k)
+        # scores and col cache of checkpoint rows, scores and row cache of checkpoint columns
+        self.row_checkpoints = np.empty((2, len(checkpoint_rows), lenB + 1), dtype=np.float64)
+        self.col_checkpoints = np.empty((2, len(checkpoint_cols), lenA + 1), dtype=np.float64)
+        self.row_checkpoints[0, :, 0] = wavefront.first_col[checkpoint_rows]
+        self.col_checkpoints[0, :, 0] = wavefront.first_row[checkpoint_cols]
+
+        best_score = max(wavefront.first_col.max(), wavefront.first_row.max())
+        best_cells = []
+        for d, lo, hi, scores, _ in wavefront:
+            # checkpoint rows and columns crossing this anti-diagonal
+            first, last = checkpoint_rows.searchsorted(lo), checkpoint_rows.searchsorted(hi, 'right')
+            if first < last:
+                rows = checkpoint_rows[first:last]
+                indexes = np.arange(first, last)
+                self.row_checkpoints[0, indexes, d - rows] = scores[rows - lo]
+                self.row_checkpoints[1, indexes, d - rows] = wavefront.col_cache[rows]
+            first, last = checkpoint_cols.searchsorted(d - hi), checkpoint_cols.searchsorted(d - lo, 'right')
+            if first < last:
+                rows = d - checkpoint_cols[first:last]
+                indexes = np.arange(first, last)
+                self.col_checkpoints[0, indexes, rows] = scores[rows - lo]
+                self.col_checkpoints[1, indexes, rows] = wavefront.row_cache[rows]
+
+            if not align_globally:
+                # cells, which might score the same as the best cell (within rint precision)
+                diagonal_best = scores.max()
+                if diagonal_best > best_score:
+                    best_score = diagonal_best
+                    best_cells = [cell for cell in best_cells if cell[2] > best_score - 0.001]
+                if diagonal_best > best_score - 0.001:
+                    best_cells.extend((lo + i, d - lo - i, scores[i])
+                                      for i in np.flatnonzero(scores > best_score - 0.001))
+        self.best_score = float(best_score)
+        self.local_starts = sorted(((float(score), (row, col)) for row, col, score in best_cells
+                                    if rint(abs(score - best_score)) <= 0), key=lambda start: start[1])
+        self.last_score = float(scores[-1])
+
+        # Cached bands, as tuples (first row, first col, scores, trace), most recently used first
+        self.bands = []
+        self.trace_overrides = {}
+        self.last_accessed = None
+        self.score_matrix = _LazyMatrix(self, 0)
+        self.trace_matrix = _LazyMatrix(self, 1)
+
+    def cell(self, row, col):
+        """ Returns tuple (score, trace) of given cell """
+        if row == 0:
+            return self.wavefront.first_row[col], 0
+        if col == 0:
+            return self.wavefront.first_col[row], 0
+        going_up = self.last_accessed == (row + 1, col)
+        self.last_accessed = row, col
+        for band in self.bands:
+            first_row, first_col, scores, trace = band
+            if 0 <= row - first_row < scores.shape[0] and 0 <= col - first_col < scores.shape[1]:
+                break
+        else:
+            if going_up:
+                band = self._compute_col_band((col - 1) // self.k, row)
+            else:
+                band = self._compute_row_band((row - 1) // self.k, col)
+            self.bands = [band] + self.bands[:self.cached_bands - 1]
+            first_row, first_col, scores, trace = band
+        if self.trace_overrides and (row, col) in self.trace_overrides:
+            return scores[row - first_row, col - first_col], self.trace_overrides[(row, col)]
+        return scores[row - first_row, col - first_col], trace[row - first_row, col - first_col]
+
+    def _compute_row_band(self, index, last_col):
+        """ Recomputes rows from index * k + 1 to (index + 1) * k, up to given column, from the checkpoint """
+        wavefront = self.wavefront
+        start, end = index * self.k, min((index + 1) * self.k, wavefront.lenA)
+        if index == 0:
+            top_scores, top_col_cache = wavefront.first_row, wavefront.col_init
+        else:
+            top_scores, top_col_cache = self.row_checkpoints[:, index - 1]
+        block = wavefront.block(start, end, 0, last_col, top_scores[:last_col + 1], top_col_cache[:last_col + 1],
+                                wavefront.first_col[start:end + 1], wavefront.row_init[start:end + 1])
+        scores, trace = self._compute_band(block)
+        return start + 1, 0, scores[1:], trace[1:]
+
+    def _compute_col_band(self, index, last_row):
+        """ Recomputes columns from index * k + 1 to (index + 1) * k, up to given row, from the checkpoint """
+        wavefront = self.wavefront
+        start, end = index * self.k, min((index + 1) * self.k, wavefront.lenB)
+        if index == 0:
+            left_scores, left_row_cache = wavefront.first_col, wavefront.row_init
+        else:
+            left_scores, left_row_cache = self.col_checkpoints[:, index - 1]
+        block = wavefront.block(0, last_row, start, end,
+                                wavefront.first_row[start:end + 1], wavefront.col_init[start:end + 1],
+                                left_scores[:last_row + 1], left_row_cache[:last_row + 1])
+        scores, trace = self._compute_band(block)
+        return 0, start + 1, scores[:, 1:], trace[:, 1:]
+
+    @staticmethod
+    def _compute_band(block):
+        """ Returns score and trace matrices of given block """
+        block.with_trace = True
+        scores = np.empty((block.lenA + 1, block.lenB + 1), dtype=np.float64)
+        trace = np.zeros((block.lenA + 1, block.lenB + 1), dtype=np.uint8)
+        _fill_matrices(block, scores, trace)
+        return scores, trace
+
+
+class SpilledMatrices(object):
+    """ Score and trace matrices kept in memory-mapped files, for matrices which do not fit in memory.
+        Matrices are filled in bands of tile_size rows, each band tile by tile from left to right, as blocks of
+        wavefront computed in memory (see Wavefront.block). Rows of a tile are written to the files, which are
+        mapped only when filled, so that written pages do not stay in memory of the process. Scores are stored as
+        in make_score_matrix (type given by score_type) and trace of columns from 1 as 5 bit planes packed by
+        np.packbits in each row, 5 bits instead of a byte per cell. Trace of a cell is read from its byte of each
+        plane, as traceback reads cells of both rows and columns (looking for gap openings). Files are created in
+        a new temporary directory inside directory (by default, the default directory of tempfile module), close()
+        removes them, as does garbage collection of the matrices (e.g. of a lazy traceback dropped before it
+        started).
+
+        Attributes score_matrix and trace_matrix support matrix[row][col] access as in Bio.pairwise2,
+        best_score, local_starts and last_score are the same as in CheckpointedMatrices.
+    """
+    # multiple of 8, so that packed trace of a tile starts at a byte; a tile takes about 30 bytes per cell
+    tile_size = 2048
+
+    def __init__(self, sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+                 penalize_extend_when_opening, penalize_end_gaps, align_globally, directory=None):
+        self.wavefront = wavefront = Wavefront(sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+                                               penalize_extend_when_opening, penalize_end_gaps, align_globally,
+                                               with_trace=True)
+        lenA, lenB = wavefront.lenA, wavefront.lenB
+        # directory is not referenced by lazy matrices referencing back the matrices,
+        # so that it is removed as soon as the matrices are collected
+        self._directory = _TemporaryDirectory(directory)
+        self.directory = self._directory.path
+        self.scores = self.trace = self.score_matrix = None
+        dtype = score_type(wavefront)
+        trace_shape = (lenA + 1, 5, (lenB + 7) // 8)
+        paths = os.path.join(self.directory, 'scores'), os.path.join(self.directory, 'trace')
+        try:
+            with open(paths[0], 'wb') as score_file, open(paths[1], 'wb') as trace_file:
+                score_file.truncate((lenA + 1) * (lenB + 1) * np.dtype(dtype).itemsize)
+                trace_file.truncate(int(np.prod(trace_shape)))
+                self._fill(align_globally, score_file, trace_file, dtype)
+            self.scores = np.memmap(paths[0], mode='r', shape=(lenA + 1, lenB + 1), dtype=dtype)
+            # indexing plain arrays is faster than indexing memmap objects
+            self.trace = np.memmap(paths[1], mode='r', shape=trace_shape, dtype=np.uint8).view(np.ndarray)
+        except BaseException:
+            self.close()
+            raise
+        self.trace_overrides = {}
+        self.score_matrix = self.scores
+        self.trace_matrix = _LazyMatrix(self, 1)
+
+    def _fill(self, align_globally, score_file, trace_file, dtype):
+        wavefront = self.wavefront
+        lenA, lenB = wavefront.lenA, wavefront.lenB
+        tile_size = self.tile_size
+        score_size, packed_size = np.dtype(dtype).itemsize, (lenB + 7) // 8
+        score_file.write(wavefront.first_row.astype(dtype).tostring())
+        # scores and col cache of the row above the band of tiles
+        top = np.array([wavefront.first_row, wavefront.col_init], dtype=np.float64)
+        best_score = wavefront.first_row.max()
+        best_cells = [(0, col, wavefront.first_row[col])
+                      for col in np.flatnonzero(wavefront.first_row > best_score - 0.001).tolist()]
+        for row_start in xrange(0, lenA, tile_size):
+            row_end = min(row_start + tile_size, lenA)
+            # scores and row cache of the column on the left of the tile
+            left = wavefront.first_col[row_start:row_end + 1], wavefront.row_init[row_start:row_end + 1]
+            bottom = np.empty_like(top)
+            bottom[:, 0] = wavefront.first_col[row_end], wavefront.col_init[0]
+            if lenB == 0:
+                score_file.write(wavefront.first_col[row_start + 1:row_end + 1].astype(dtype).tostring())
+            for col_start in xrange(0, lenB, tile_size):
+                col_end = min(col_start + tile_size, lenB)
+                block = wavefront.block(row_start, row_end, col_start, col_end, top[0, col_start:col_end + 1],
+                                        top[1, col_start:col_end + 1], left[0], left[1])
+                last_row, last_col = block.lenA, block.lenB
+                scores = np.empty((last_row + 1, last_col + 1), dtype=np.float64)
+                trace = np.zeros((last_row + 1, last_col + 1), dtype=np.uint8)
+                scores[:, 0] = block.first_col
+                scores[0, :] = block.first_row
+                right_row_cache = np.empty(last_row + 1, dtype=np.float64)
+                # Cells (i, d - i) of anti-diagonal d form a slice with step lenB of flat arrays, as in _fill_matrices
+                score_flat, trace_flat = scores.ravel(), trace.ravel()
+                for d, lo, hi, diagonal_scores, diagonal_trace in block:
+                    cells = slice(lo * last_col + d, hi * last_col + d + 1, last_col)
+                    score_flat[cells] = diagonal_scores
+                    trace_flat[cells] = diagonal_trace
+                    if hi == last_row:
+                        bottom[1, col_start + d - hi] = block.col_cache[hi]
+                    if lo <= d - last_col <= hi:
+                        right_row_cache[d - last_col] = block.row_cache[d - last_col]
+                left = scores[:, -1], right_row_cache
+                bottom[0, col_start + 1:col_end + 1] = scores[-1, 1:]
+
+                # Column 0 is written with the first tile of a band, trace of column 0 is not stored
+                first_col = 0 if col_start == 0 else 1
+                tile_scores = scores[1:, first_col:].astype(dtype)
+                # planes of bits 16, 8, 4, 2, 1 of trace, read back in cell() by np.unpackbits
+                packed = np.empty((last_row, 5, (last_col + 7) // 8), dtype=np.uint8)
+                for plane in xrange(5):
+                    packed[:, plane] = np.packbits((trace[1:, 1:] >> (4 - plane)) & 1, axis=1)
+                for i in xrange(last_row):
+                    row = row_start + 1 + i
+                    score_file.seek((row * (lenB + 1) + col_start + first_col) * score_size)
+                    score_file.write(tile_scores[i].tostring())
+                    for plane in xrange(5):
+                        trace_file.seek((row * 5 + plane) * packed_size + col_start // 8)
+                        trace_file.write(packed[i, plane].tostring())
+
+                if not align_globally:
+                    # cells, which might score the same as the best cell (within rint precision)
+                    tile_best = scores[1:, first_col:].max()
+                    if tile_best > best_score:
+                        best_score = tile_best
+                        best_cells = [cell for cell in best_cells if cell[2] > best_score - 0.001]
+                    if tile_best > best_score - 0.001:
+                        rows, cols = np.nonzero(scores[1:, first_col:] > best_score - 0.001)
+                        best_cells.extend(zip((rows + row_start + 1).tolist(), (cols + col_start + first_col).tolist(),
+                                              scores[rows + 1, cols + first_col].tolist()))
+            top = bottom
+        self.last_score = float(top[0, -1])
+        if align_globally:
+            self.best_score, self.local_starts = self.last_score, []
+        else:
+            self.best_score = float(best_score)
+            self.local_starts = sorted(((float(score), (row, col)) for row, col, score in best_cells
+                                        if rint(abs(score - best_score)) <= 0), key=lambda start: start[1])
+
+    def cell(self, row, col):
+        """ Returns tuple (score, trace) of given cell """
+        if self.trace_overrides and (row, col) in self.trace_overrides:
+            return self.scores[row, col], self.trace_overrides[(row, col)]
+        if col == 0:
+            return self.scores[row, col], 0
+        # bits of planes 16, 8, 4, 2, 1 in bytes of column col - 1, the highest bit first as in np.packbits
+        shift = 7 - (col - 1) % 8
+        trace = 0
+        for byte in self.trace[row, :, (col - 1) // 8].tolist():
+            trace = trace << 1 | (byte >> shift) & 1
+        return self.scores[row, col], trace
+
+    def close(self):
+        """ Removes files of matrices, which can not be used anymore """
+        self.scores = self.trace = self.score_matrix = None
+        self._directory.remove()
+
+
+class _TemporaryDirectory(object):
+    """ Temporary directory, removed by remove() or when the object is garbage collected """
+
+    def __init__(self, directory=None):
+        self.path = tempfile.mkdtemp(prefix='pairwise2-', dir=directory)
+
+    def remove(self, rmtree=shutil.rmtree):
+        # rmtree is kept as default argument, as module globals may be cleared when called at exit
+        rmtree(self.path, ignore_errors=True)
+
+    def __del__(self):
+        self.remove()
+
+
+class BandedMatrices(object):
+    """ Score and trace matrices of global alignment, computed only for cells within k of the diagonals
+        going through the top left and the bottom right corners of matrices. Cells in row i are stored
+        in row i of arrays, from column i + min offset to column i + max offset.
+
+        Attributes score_matrix and trace_matrix support matrix[row][col] access as in Bio.pairwise2,
+        last_score is score of the bottom right cell. Cells outside of the band have score OUTSIDE_BAND.
+        Whether the band could have changed the alignments is told by is_exact().
+        With score_only only last_score is computed.
+    """
+
+    def __init__(self, sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+                 penalize_extend_when_opening, penalize_end_gaps, k, score_only=False):
+        lenA, lenB = len(sequenceA), len(sequenceB)
+        self.k = k
+        self.offsets = min_offset, max_offset = min(0, lenB - lenA) - k, max(0, lenB - lenA) + k
+        self.gaps = open_A, extend_A, open_B, extend_B
+        self.penalize_end_gaps = penalize_end_gaps
+        self.wavefront = wavefront = Wavefront(sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+                                               penalize_extend_when_opening, penalize_end_gaps, True,
+                                               with_trace=not score_only, band=self.offsets)
+        width = max_offset - min_offset + 1
+        # number of computed cells, for profiling
+        self.cells = (lenA + 1) * width
+        if not score_only:
+            self.scores = np.full((lenA + 1, width), OUTSIDE_BAND, dtype=np.float64)
+            # Traceback reads cells outside of the band when looking for gap openings, their trace must not be empty
+            self.trace = np.full((lenA + 1, width), 2, dtype=np.uint8)
+            # Flat views: cells (i, d - i) of anti-diagonal d form a slice with step width - 2
+            score_flat, trace_flat = self.scores.ravel(), self.trace.ravel()
+        for d, lo, hi, scores, trace in wavefront:
+            if not score_only:
+                cells = slice(lo * (width - 2) + d - min_offset, hi * (width - 2) + d - min_offset + 1, width - 2)
+                score_flat[cells] = scores
+                trace_flat[cells] = trace
+        self.last_score = float(scores[-1])
+        self.score_matrix = _LazyMatrix(self, 0)
+        self.trace_matrix = _LazyMatrix(self, 1)
+
+    def is_exact(self):
+        """ Returns true, if no alignment leaving the band can have score close to last_score,
+            so alignments found in the band are the same as in whole matrices. """
+        return self.k >= self.exact_band(self.last_score)
+
+    def exact_band(self, score):
+        """ Returns the smallest positive k, such that all alignments leaving band k have scores lower
+            than given score (by more than rint precision). With k = min(lenA, lenB) the band covers whole matrices. """
+        lenA, lenB = self.wavefront.lenA, self.wavefront.lenB
+        whole_matrix = min(lenA, lenB)
+        gap_score = max(self.gaps)
+        if gap_score > 0:
+            return whole_matrix
+        if not all(self.penalize_end_gaps):
+            gap_score = 0
+        max_match = self.wavefront.scores.max()
+
+        # An alignment going through a cell outside of band k has at least 2 * k + 2 + |lenB - lenA| gaps.
+        # With g gaps, it has (lenA + lenB - g) / 2 matches and each gap costs at least gap_score.
+        # Bound for g gaps is linear in g, so its maximum is for the lowest or the highest possible g.
+        def bound(k):
+            gaps_counts = (2 * k + 2 + abs(lenB - lenA), lenA + lenB)
+            return max((lenA + lenB - g) / 2.0 * max_match + g * gap_score for g in gaps_counts)
+
+        # Scores closer than 0.001 are equal for traceback of Bio.pairwise2
+        score -= 0.002
+        # Bound decreases by step with each k, until it reaches bound for alignment made of gaps only
+        step = max_match - 2 * gap_score
+        if bound(whole_matrix) >= score or step <= 0:
+            return whole_matrix
+        k = max(int((bound(0) - score) / step), 1)
+        while bound(k) >= score:
+            k += 1
+        return min(k, whole_matrix)
+
+    def cell(self, row, col):
+        """ Returns tuple (score, trace) of given cell """
+        if row == 0:
+            return self.wavefront.first_row[col], 0
+        if col == 0:
+            return self.wavefront.first_col[row], 0
+        index = col - row - self.offsets[0]
+        if 0 <= index < self.scores.shape[1]:
+            return self.scores[row, index], self.trace[row, index]
+        return OUTSIDE_BAND, 2
+
+
+class _LazyMatrix(object):
+    """ Score or trace matrix of CheckpointedMatrices, BandedMatrices or SpilledMatrices """
+
+    def __init__(self, matrices, index):
+        self.matrices = matrices
+        self.index = index
+
+    def __getitem__(self, row):
+        return _LazyRow(self.matrices, row, self.index)
+
+
+class _LazyRow(object):
+    """ Row of score or trace matrix of CheckpointedMatrices, BandedMatrices or SpilledMatrices """
+    __slots__ = ('matrices', 'row', 'index')
+
+    def __init__(self, matrices, row, index):
+        self.matrices = matrices
+        self.row = row
+        self.index = index
+
+    def __getitem__(self, col):
+        return self.matrices.cell(self.row, col)[self.index]
+
+    def __setitem__(self, col, value):
+        if self.index == 0:
+            raise TypeError('scores of checkpointed matrices can not be changed')
+        self.matrices.trace_overrides[(self.row, col)] = value
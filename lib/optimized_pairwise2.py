@@ -1,24 +1,145 @@
+import collections
+import functools
+import heapq
 import itertools
-import Bio.pairwise2 as pairwise2
+from . import lazy_import
+from . import profiling
 
-def _find_start(score_matrix, best_score): 
+# Biopython and numpy engine are imported by the first alignment which needs them
+pairwise2 = lazy_import.LazyModule('Bio.pairwise2')
+numpy_engine = lazy_import.LazyModule(__name__.rpartition('.')[0] + '.numpy_engine') \
+    if lazy_import.module_available('numpy') else None
+
+
+def _make_score_matrix_fast(sequenceA, sequenceB, match_fn, *args):
+    """Call pairwise2._make_score_matrix_fast, raising errors of match function.
+    C code returns matrices even if match function fails (e.g. with KeyError of dictionary_match),
+    so match function is called first for every pair of symbols of the sequences, raising its error here.
+    """
+    if not isinstance(match_fn, pairwise2.identity_match):
+        symbolsB = set(sequenceB)
+        for symbolA in set(sequenceA):
+            for symbolB in symbolsB:
+                match_fn(symbolA, symbolB)
+    return pairwise2._make_score_matrix_fast(sequenceA, sequenceB, match_fn, *args)
+
+# Engines computing score and trace matrices for affine gap penalties.
+# Each engine takes same arguments as pairwise2._make_score_matrix_fast and returns (score_matrix, trace_matrix)
+SCORE_MATRIX_ENGINES = {'biopython': _make_score_matrix_fast}
+
+
+def _numpy_engine_function(name):
+    """Return function calling function of numpy engine, which is imported by the first call."""
+    def engine_function(*args, **keywds):
+        return getattr(numpy_engine, name)(*args, **keywds)
+    engine_function.__name__ = name
+    return engine_function
+
+if numpy_engine is not None:
+    SCORE_MATRIX_ENGINES['numpy'] = _numpy_engine_function('make_score_matrix')
+
+# With engine='auto', bigger matrices are kept in arrays of numpy engine (about 5 bytes per cell
+# for integer scores, 9 bytes otherwise) instead of lists of floats (about 32 bytes per cell).
+# This saves memory, not time: for identity_match on strings numpy engine is not faster than Biopython C code.
+ARRAY_MATRICES_MIN_CELLS = 2 ** 22
+
+# Smaller matrices of dictionary_match are filled faster by Biopython C code, despite calls of match function
+DICTIONARY_MATCH_ARRAY_MIN_CELLS = 2 ** 13
+
+# With one_alignment_only and checkpointed='auto', bigger matrices are not kept in memory, only their checkpoints
+# (see numpy_engine.CheckpointedMatrices). Memory still grows faster than lengths of sequences, it is not linear.
+# Traceback recomputing bands takes about 1.6 times longer, for 2 (integer scores) to 3.4 times less memory
+# with 8192 x 8192 matrices (e.g. 607 MB in 6.0 s instead of 178 MB in 10.3 s with globalms), and 6 times less
+# with 16384 x 16384 ones. With 4096 x 4096 matrices memory is only 1.2 to 1.9 times less, so they are kept whole.
+CHECKPOINTED_MIN_CELLS = 2 ** 26
+
+# With band='auto', band width used to estimate the band width needed for exact results
+BAND_AUTO_START = 16
+
+# score_many computes scores of pairs of strings up to this length in batches of numpy engine
+SHORT_PAIR_MAX_LENGTH = 256
+
+# Biopython C code computes scores of identity_match faster than batches, unless matrices are tiny
+IDENTITY_MATCH_BATCH_MAX_CELLS = 400
+
+
+def _select_engine(engine, match_fn, sequenceA, sequenceB):
+    """Return score matrix function of given engine name.
+    For engine 'auto' choose numpy engine where it is faster (match functions called by Biopython
+    for every cell), and for matrices of at least ARRAY_MATRICES_MIN_CELLS, which take less memory in it.
+    """
+    if engine == 'auto':
+        # Biopython C code calls match function for every cell, unless it is identity_match on strings
+        cells = len(sequenceA) * len(sequenceB)
+        if numpy_engine is not None and ((isinstance(match_fn, pairwise2.dictionary_match) and
+                                          cells >= DICTIONARY_MATCH_ARRAY_MIN_CELLS) or
+                                         (isinstance(match_fn, pairwise2.identity_match) and
+                                          isinstance(sequenceA, list)) or
+                                         cells >= ARRAY_MATRICES_MIN_CELLS):
+            engine = 'numpy'
+        else:
+            engine = 'biopython'
+    try:
+        return SCORE_MATRIX_ENGINES[engine]
+    except KeyError:
+        raise ValueError('unknown engine %r, available engines: %s'
+                         % (engine, ', '.join(sorted(SCORE_MATRIX_ENGINES))))
+
+def _find_start(score_matrix, best_score, row_maxima=None): 
     """Return a list of starting points (score, (row, col)). 
     Indicating every possible place to start the tracebacks. 
+    These are cells with the best score, within rint precision as in Bio.pairwise2.
+    Only rows, which maximum (found by builtin max, unless given) is close enough, are scanned in Python.
     """ 
-    nrows, ncols = len(score_matrix), len(score_matrix[0]) 
-
-    return [(best_score, (row, col)) for row, col in itertools.product(xrange(nrows), xrange(ncols))
-            if score_matrix[row][col] == best_score]
+    if row_maxima is None:
+        row_maxima = map(max, score_matrix)
+    low = best_score - 0.001
+    starts = []
+    for row, (values, row_max) in enumerate(itertools.izip(score_matrix, row_maxima)):
+        if row_max > low:
+            starts.extend((score, (row, col)) for col, score in enumerate(values)
+                          if score > low and pairwise2.rint(abs(score - best_score)) <= 0)
+    return starts
 
 def _align(sequenceA, sequenceB, match_fn, gap_A_fn, gap_B_fn, 
            penalize_extend_when_opening, penalize_end_gaps, 
            align_globally, gap_char, force_generic, score_only, 
-           one_alignment_only):
+           one_alignment_only, engine='auto', checkpointed='auto', band=None,
+           max_alignments=None, lazy=False, min_score=None, xdrop=None, spill=None):
     """Return a list of alignments between two sequences or its score.
-       Use optimized methods where possible""" 
+       Use optimized methods where possible.
+       With lazy=True a generator yielding alignments in the same order is returned,
+       max_alignments limits number of returned alignments.
+       With min_score, alignments are returned only if their score is at least min_score,
+       otherwise score is None and list of alignments is empty. Computation stops as soon as
+       no alignment can reach min_score. With xdrop (local alignments with score_only or min_score only),
+       the score is computed by numpy engine only until all cells of the last anti-diagonals are lower than
+       the best score by more than xdrop, which is faster, but may miss alignments starting far from the best
+       one found so far. With min_score, xdrop only prunes the score compared with min_score,
+       alignments of pairs reaching it are recovered from whole matrices.
+       With one_alignment_only and checkpointed (true, or 'auto' for matrices of at least CHECKPOINTED_MIN_CELLS),
+       only checkpoints of matrices are kept in memory and their parts are recomputed during traceback,
+       which takes O((lenA + lenB) * sqrt(min(lenA, lenB))) memory (see numpy_engine.CheckpointedMatrices).
+       This is less memory than of whole matrices, but not linear memory: very long sequences need spill.
+       With spill (a directory, or True for the default temporary directory), score and trace matrices
+       are kept in memory-mapped files there, removed after traceback, so that all alignments of matrices
+       larger than memory can be recovered.
+       Time of stages is measured if profiling is enabled (see profiling module).""" 
 
+    stats = profiling.current()
+    stats.start()
+    return _align_stages(stats, sequenceA, sequenceB, match_fn, gap_A_fn, gap_B_fn,
+                         penalize_extend_when_opening, penalize_end_gaps, align_globally, gap_char,
+                         force_generic, score_only, one_alignment_only, engine, checkpointed, band,
+                         max_alignments, lazy, min_score, xdrop, spill)
+
+def _align_stages(stats, sequenceA, sequenceB, match_fn, gap_A_fn, gap_B_fn,
+                  penalize_extend_when_opening, penalize_end_gaps, align_globally, gap_char,
+                  force_generic, score_only, one_alignment_only, engine, checkpointed, band,
+                  max_alignments, lazy, min_score, xdrop, spill):
+    """Return result of _align, marking its stages in stats of an already started call."""
     if not sequenceA or not sequenceB: 
-        return [] 
+        return iter([]) if lazy else []
     try: 
         sequenceA + gap_char 
         sequenceB + gap_char 
@@ -31,51 +152,599 @@ def _align(sequenceA, sequenceB, match_fn, gap_A_fn, gap_B_fn,
         sequenceA = str(sequenceA) 
     if not isinstance(sequenceB, list): 
         sequenceB = str(sequenceB) 
+    if band is not None and not align_globally:
+        raise ValueError('band can be used only with global alignments')
+    if band is not None and band != 'auto' and band < 1:
+        raise ValueError("band must be a positive number or 'auto'")
+    if xdrop is not None and align_globally:
+        raise ValueError('xdrop can be used only with local alignments')
+    if xdrop is not None and not score_only and min_score is None:
+        raise ValueError('xdrop can be used only with score_only or min_score')
+    recover = functools.partial(_recover_alignments, sequenceA, sequenceB, align_globally=align_globally,
+                                gap_char=gap_char, one_alignment_only=one_alignment_only, gap_A_fn=gap_A_fn,
+                                gap_B_fn=gap_B_fn, max_alignments=max_alignments, lazy=lazy)
+    stats.mark('preparation')
+    lenA, lenB = len(sequenceA), len(sequenceB)
+    affine = (not force_generic) and isinstance(gap_A_fn, pairwise2.affine_penalty) \
+        and isinstance(gap_B_fn, pairwise2.affine_penalty)
+    if spill and not (affine and engine in ('auto', 'numpy') and numpy_engine is not None):
+        # matrices would be built in memory otherwise
+        raise ValueError("spill can be used only with affine gap penalties on engine 'auto' or 'numpy' "
+                         "(without force_generic, with numpy installed)")
+
+    if min_score is not None or xdrop is not None:
+        # Score is computed first, alignments only if it is high enough
+        if affine and engine in ('auto', 'numpy') and numpy_engine is not None:
+            score = numpy_engine.compute_score(
+                sequenceA, sequenceB, match_fn, gap_A_fn.open, gap_A_fn.extend, gap_B_fn.open,
+                gap_B_fn.extend, penalize_extend_when_opening, penalize_end_gaps,
+                align_globally, min_score=min_score, xdrop=xdrop)
+        else:
+            # stages of the score pass are timed as matrix fill of this call
+            score = _align_stages(profiling._DISABLED, sequenceA, sequenceB, match_fn, gap_A_fn, gap_B_fn,
+                                  penalize_extend_when_opening, penalize_end_gaps, align_globally, gap_char,
+                                  force_generic, True, one_alignment_only, engine, checkpointed, None,
+                                  None, False, None, None, None)
+            if min_score is not None and score < min_score:
+                score = None
+        stats.mark('matrix_fill')
+        if score_only or score is None:
+            # otherwise cells are counted once, when matrices are filled for alignments
+            stats.add_cells(lenA * lenB)
+        if score_only:
+            return score
+        if score is None:
+            return iter([]) if lazy else []
 
-    if (not force_generic) and isinstance(gap_A_fn, pairwise2.affine_penalty) \
-        and isinstance(gap_B_fn, pairwise2.affine_penalty): 
+    if affine: 
         open_A, extend_A = gap_A_fn.open, gap_A_fn.extend 
         open_B, extend_B = gap_B_fn.open, gap_B_fn.extend 
-        x = pairwise2._make_score_matrix_fast( 
+        if band is not None and engine in ('auto', 'numpy') and numpy_engine is not None:
+            result = _align_banded(
+                sequenceA, sequenceB, match_fn, open_A, extend_A, open_B,
+                extend_B, penalize_extend_when_opening, penalize_end_gaps,
+                score_only, band, recover, stats)
+            if result is not None:
+                return result
+        stats.add_cells(lenA * lenB)
+        make_score_matrix = _select_engine(engine, match_fn, sequenceA, sequenceB)
+        if score_only and make_score_matrix is SCORE_MATRIX_ENGINES.get('numpy'):
+            # Score does not need whole matrices, only the last rows of them
+            score = numpy_engine.compute_score(
+                sequenceA, sequenceB, match_fn, open_A, extend_A, open_B,
+                extend_B, penalize_extend_when_opening, penalize_end_gaps,
+                align_globally)
+            stats.mark('matrix_fill')
+            return score
+        if spill and not score_only:
+            return _align_spilled(
+                sequenceA, sequenceB, match_fn, open_A, extend_A, open_B,
+                extend_B, penalize_extend_when_opening, penalize_end_gaps,
+                align_globally, recover, None if spill is True else spill, lazy)
+        if one_alignment_only and _use_checkpoints(checkpointed, engine, sequenceA, sequenceB):
+            return _align_checkpointed(
+                sequenceA, sequenceB, match_fn, open_A, extend_A, open_B,
+                extend_B, penalize_extend_when_opening, penalize_end_gaps,
+                align_globally, recover)
+        x = make_score_matrix( 
             sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, 
             extend_B, penalize_extend_when_opening, penalize_end_gaps, 
             align_globally, score_only) 
     else: 
+        stats.add_cells(lenA * lenB)
         x = pairwise2._make_score_matrix_generic( 
             sequenceA, sequenceB, match_fn, gap_A_fn, gap_B_fn, 
             penalize_end_gaps, align_globally, score_only) 
     score_matrix, trace_matrix = x 
+    stats.mark('matrix_fill')
 
     # Find the highest score. 
     nrows, ncols = len(score_matrix), len(score_matrix[0]) 
  
+    if hasattr(score_matrix, 'array'):
+        # Matrices of numpy engine are backed by arrays
+        best_score, starts = numpy_engine.find_starts(score_matrix.array, align_globally)
+    elif align_globally:
+        best_score = score_matrix[nrows-1][ncols-1]
+        starts = [(best_score, (nrows-1,ncols-1))]
+    else:
+        row_maxima = map(max, score_matrix)
+        best_score = max(row_maxima)
+        if not score_only: 
+            starts = _find_start(score_matrix, best_score, row_maxima) 
+    stats.mark('find_starts')
+    if score_only: 
+        return best_score 
+
+    return recover(starts, score_matrix, trace_matrix)
+
+def _use_checkpoints(checkpointed, engine, sequenceA, sequenceB):
+    """Return true, if only checkpoints of score and trace matrices should be kept in memory."""
+    if engine not in ('auto', 'numpy') or numpy_engine is None:
+        return False
+    if checkpointed == 'auto':
+        return len(sequenceA) * len(sequenceB) >= CHECKPOINTED_MIN_CELLS
+    return bool(checkpointed)
+
+def _align_checkpointed(sequenceA, sequenceB, match_fn, open_A, extend_A, open_B,
+                        extend_B, penalize_extend_when_opening, penalize_end_gaps,
+                        align_globally, recover):
+    """Return the first optimal alignment, recomputing parts of matrices during traceback.
+       Same alignment as with full matrices is found, because traceback is done by pairwise2."""
+    matrices = numpy_engine.CheckpointedMatrices(
+        sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+        penalize_extend_when_opening, penalize_end_gaps, align_globally)
+    if align_globally:
+        starts = [(matrices.last_score, (len(sequenceA), len(sequenceB)))]
+    else:
+        starts = matrices.local_starts
+    return recover(starts, matrices.score_matrix, matrices.trace_matrix)
+
+def _align_spilled(sequenceA, sequenceB, match_fn, open_A, extend_A, open_B,
+                   extend_B, penalize_extend_when_opening, penalize_end_gaps,
+                   align_globally, recover, directory, lazy):
+    """Return alignments recovered from matrices in memory-mapped files in directory, removing the files
+       when they are recovered (or, if lazy, when the generator of alignments is finished, closed
+       or garbage collected, also if it was never started)."""
+    matrices = numpy_engine.SpilledMatrices(
+        sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+        penalize_extend_when_opening, penalize_end_gaps, align_globally, directory)
     if align_globally:
-        starts = [(score_matrix[nrows-1][ncols-1], (nrows-1,ncols-1))]
-        if score_only: 
-            return starts[0][0]
+        starts = [(matrices.last_score, (len(sequenceA), len(sequenceB)))]
     else:
-        best_score = max(score_matrix[row][col] for row, col in itertools.product(xrange(nrows), xrange(ncols)))
-        if score_only: 
-            return best_score 
+        starts = matrices.local_starts
+    try:
+        alignments = recover(starts, matrices.score_matrix, matrices.trace_matrix)
+    except BaseException:
+        matrices.close()
+        raise
+    if lazy:
+        return _closing(alignments, matrices)
+    matrices.close()
+    return alignments
 
-        starts = _find_start(score_matrix, best_score) 
+def _closing(alignments, matrices):
+    """Yield alignments, then close matrices."""
+    try:
+        for alignment in alignments:
+            yield alignment
+    finally:
+        matrices.close()
 
-    return pairwise2._recover_alignments(sequenceA, sequenceB, starts, score_matrix, 
-                                         trace_matrix, align_globally, gap_char, 
-                                         one_alignment_only, gap_A_fn, gap_B_fn) 
+def _align_banded(sequenceA, sequenceB, match_fn, open_A, extend_A, open_B,
+                  extend_B, penalize_extend_when_opening, penalize_end_gaps,
+                  score_only, band, recover, stats):
+    """Return global alignments or score computed only near the diagonal,
+       or None if cells outside of the band could change them."""
+    lenA, lenB = len(sequenceA), len(sequenceB)
+    args = (sequenceA, sequenceB, match_fn, open_A, extend_A, open_B, extend_B,
+            penalize_extend_when_opening, penalize_end_gaps)
+    if band == 'auto':
+        # Score found in a narrow band tells how wide band gives exact results
+        matrices = numpy_engine.BandedMatrices(*args, k=BAND_AUTO_START, score_only=True)
+        stats.add_cells(matrices.cells)
+        band = matrices.exact_band(matrices.last_score)
+        # Wide bands are not much cheaper than whole matrices
+        if 2 * (2 * band + abs(lenA - lenB)) >= max(lenA, lenB):
+            return None
+        if score_only and band <= BAND_AUTO_START:
+            stats.mark('matrix_fill')
+            return matrices.last_score
+    matrices = numpy_engine.BandedMatrices(*args, k=band, score_only=score_only)
+    stats.add_cells(matrices.cells)
+    if not matrices.is_exact():
+        return None
+    if score_only:
+        stats.mark('matrix_fill')
+        return matrices.last_score
+    return recover([(matrices.last_score, (lenA, lenB))], matrices.score_matrix, matrices.trace_matrix)
 
-class align(object):
-    """This class provides same functionalities as Bio.pairwise2 align class, but with some methods overloaded as optimized.""" 
+def _recover_alignments(sequenceA, sequenceB, starts, score_matrix,
+                        trace_matrix, align_globally, gap_char,
+                        one_alignment_only, gap_A_fn, gap_B_fn,
+                        max_alignments=None, lazy=False):
+    """Do the backtracing and return a list of alignments (or generator of them, if lazy).
+       Same as pairwise2._recover_alignments, but at most max_alignments are recovered."""
+    stats = profiling.current()
+    # banded and checkpointed matrices are filled (and their starts found) before recovering alignments
+    stats.mark('matrix_fill')
+    alignments = _iter_alignments(sequenceA, sequenceB, starts, score_matrix, trace_matrix,
+                                  align_globally, gap_char, one_alignment_only, gap_A_fn, gap_B_fn)
+    if max_alignments is not None:
+        alignments = itertools.islice(alignments, max_alignments)
+    if lazy:
+        # time of lazy traceback is spent by the caller
+        return alignments
+    alignments = list(alignments)
+    stats.mark('traceback')
+    stats.add_alignments(len(alignments))
+    return alignments
+
+def _iter_alignments(sequenceA, sequenceB, starts, score_matrix, trace_matrix,
+                     align_globally, gap_char, one_alignment_only, gap_A_fn, gap_B_fn):
+    """Yield alignments found by backtracing, one by one.
+       Alignments are the same and in the same order as returned by pairwise2._recover_alignments,
+       which follows paths of trace matrix with a stack, and then removes duplicated and empty alignments."""
+    lenA, lenB = len(sequenceA), len(sequenceB)
+    ali_seqA, ali_seqB = sequenceA[0:0], sequenceB[0:0]
+    in_process = []
+
+    # As in pairwise2, all alignments get score of the last start,
+    # and begin of a local alignment is kept from previous alignments, until it is set again
+    begin = 0
+    for start in starts:
+        score, (row, col) = start
+        if align_globally:
+            end = None
+        else:
+            # Local alignments should start with a positive score!
+            if score <= 0:
+                continue
+            # Local alignments should not end with a gap!:
+            trace = trace_matrix[row][col]
+            if (trace - trace % 2) % 4 == 2:  # Trace contains 'nogap', fine!
+                trace_matrix[row][col] = 2
+            # If not, don't start here!
+            else:
+                continue
+            end = -max(lenA - row, lenB - col)
+            if not end:
+                end = None
+            col_distance = lenB - col
+            row_distance = lenA - row
+            ali_seqA = ((col_distance - row_distance) * gap_char +
+                        sequenceA[lenA - 1:row - 1:-1])
+            ali_seqB = ((row_distance - col_distance) * gap_char +
+                        sequenceB[lenB - 1:col - 1:-1])
+        in_process.append((ali_seqA, ali_seqB, end, row, col, False, trace_matrix[row][col]))
 
-    class alignment_function(pairwise2.align.alignment_function):
-        def __init__(self, name):
-            pairwise2.align.alignment_function.__init__(self, name)
+    tracebacks_count = 0
+    unique_alignments = set()
+    while in_process and tracebacks_count < pairwise2.MAX_ALIGNMENTS:
+        # A gap in seqB can follow a gap in seqA, but not the other way round (col_gap),
+        # because it would give redundant alignments
+        dead_end = False
+        ali_seqA, ali_seqB, end, row, col, col_gap, trace = in_process.pop()
 
-        def __call__(self, *args, **keywds): 
-                     keywds = self.decode(*args, **keywds) 
-                     return _align(**keywds) 
+        while (row > 0 or col > 0) and not dead_end:
+            cache = (ali_seqA[:], ali_seqB[:], end, row, col, col_gap)
+
+            # If trace is empty we have reached at least one border of the
+            # matrix or the end of a local aligment. Just add the rest of
+            # the sequence(s) and fill with gaps if neccessary.
+            if not trace:
+                if col and col_gap:
+                    dead_end = True
+                else:
+                    ali_seqA, ali_seqB = pairwise2._finish_backtrace(
+                        sequenceA, sequenceB, ali_seqA, ali_seqB, row, col, gap_char)
+                break
+            elif trace % 2 == 1:  # = row open = open gap in seqA
+                trace -= 1
+                if col_gap:
+                    dead_end = True
+                else:
+                    col -= 1
+                    ali_seqA += gap_char
+                    ali_seqB += sequenceB[col:col + 1]
+                    col_gap = False
+            elif trace % 4 == 2:  # = match/mismatch of seqA with seqB
+                trace -= 2
+                row -= 1
+                col -= 1
+                ali_seqA += sequenceA[row:row + 1]
+                ali_seqB += sequenceB[col:col + 1]
+                col_gap = False
+            elif trace % 8 == 4:  # = col open = open gap in seqB
+                trace -= 4
+                row -= 1
+                ali_seqA += sequenceA[row:row + 1]
+                ali_seqB += gap_char
+                col_gap = True
+            elif trace in (8, 24):  # = row extend = extend gap in seqA
+                trace -= 8
+                if col_gap:
+                    dead_end = True
+                else:
+                    col_gap = False
+                    # We need to find the starting point of the extended gap
+                    x = pairwise2._find_gap_open(sequenceA, sequenceB, ali_seqA, ali_seqB, end, row, col,
+                                                 col_gap, gap_char, score_matrix, trace_matrix, in_process,
+                                                 gap_A_fn, col, row, 'col')
+                    ali_seqA, ali_seqB, row, col, in_process, dead_end = x
+            elif trace == 16:  # = col extend = extend gap in seqB
+                trace -= 16
+                col_gap = True
+                x = pairwise2._find_gap_open(sequenceA, sequenceB, ali_seqA, ali_seqB, end, row, col,
+                                             col_gap, gap_char, score_matrix, trace_matrix, in_process,
+                                             gap_B_fn, row, col, 'row')
+                ali_seqA, ali_seqB, row, col, in_process, dead_end = x
+
+            if trace:  # There is another path to follow...
+                in_process.append(cache + (trace,))
+            trace = trace_matrix[row][col]
+            if not align_globally and score_matrix[row][col] <= 0:
+                begin = max(row, col)
+                trace = 0
+        if not dead_end:
+            tracebacks_count += 1
+            alignment = (ali_seqA[::-1], ali_seqB[::-1], score, begin, end)
+            # Remove duplicates and empty alignments, make sure end is set
+            if _hashable(alignment) not in unique_alignments:
+                unique_alignments.add(_hashable(alignment))
+                if end is None:  # global alignment
+                    end = len(alignment[0])
+                elif end < 0:
+                    end = end + len(alignment[0])
+                if begin < end:
+                    yield alignment[:4] + (end,)
+            if one_alignment_only:
+                break
+
+def _hashable(alignment):
+    """Return alignment, with sequences as tuples if they are lists"""
+    seqA, seqB = alignment[:2]
+    if isinstance(seqA, list):
+        return (tuple(seqA), tuple(seqB)) + alignment[2:]
+    return alignment
+
+class align(object):
+    """This class provides same functionalities as Bio.pairwise2 align class, but with some methods overloaded as optimized.
+       Methods accept keyword argument cache, an alignment_cache.AlignmentCache storing their results.""" 
+
+    @property
+    def alignment_function(self):
+        """Class of alignment methods, defined when first used, as it extends the one of Bio.pairwise2."""
+        return _alignment_function_class()
 
     def __getattr__(self, attr): 
         return self.alignment_function(attr) 
 
 align = align()
+
+_alignment_function = None
+
+def _alignment_function_class():
+    global _alignment_function
+    if _alignment_function is None:
+        class alignment_function(pairwise2.align.alignment_function):
+            def __init__(self, name):
+                pairwise2.align.alignment_function.__init__(self, name)
+
+            def __call__(self, *args, **keywds): 
+                         keywds = self.decode(*args, **keywds) 
+                         cache = keywds.pop('cache', None)
+                         if cache is not None:
+                             # results are looked up in alignment_cache.AlignmentCache
+                             return cache.align(keywds, _align)
+                         return _align(**keywds) 
+
+        _alignment_function = alignment_function
+    return _alignment_function
+
+
+# Keyword arguments of _align decoded once for whole batch, set in each worker process of align_many
+_batch_keywds = None
+
+def _init_batch(keywds):
+    """Set decoded arguments of a batch in worker process."""
+    global _batch_keywds
+    _batch_keywds = keywds
+
+def _align_pair(indexed_pair):
+    """Align one pair of a batch, return tuple (index, result)."""
+    index, (sequenceA, sequenceB) = indexed_pair
+    return index, _align(sequenceA=sequenceA, sequenceB=sequenceB, **_batch_keywds)
+
+def _align_chunk(indexed_pairs):
+    """Align a chunk of pairs of a batch in worker process, return list of tuples (index, result)."""
+    return [_align_pair(indexed_pair) for indexed_pair in indexed_pairs]
+
+def align_many(pairs, mode, *args, **keywds):
+    """Align many pairs of sequences with same method, using a pool of processes.
+
+       mode is a name of alignment method, e.g. 'globalms', args and keywds are passed to it as in align.<mode>,
+       without sequences. Additional keyword arguments:
+         workers - number of processes (default: number of CPUs), with workers=1 pairs are aligned in this process
+         chunksize - number of pairs sent to a worker at once (default: 16)
+         ordered - if true (default), results are yielded in order of pairs,
+                   otherwise tuples (index of pair, result) are yielded from chunks as they are computed
+         max_in_flight - number of chunks sent to workers and not yet yielded (default: 4 per worker)
+
+       Arguments are decoded once per batch and sent once to each worker, pairs can be any iterable.
+       Pairs are read from it only when there is room for them, so that streams of pairs are not read ahead."""
+    import multiprocessing
+    workers = keywds.pop('workers', None) or multiprocessing.cpu_count()
+    chunksize = keywds.pop('chunksize', 16)
+    ordered = keywds.pop('ordered', True)
+    max_in_flight = keywds.pop('max_in_flight', None) or 4 * workers
+    # sequences are given later for each pair
+    keywds = align.alignment_function(mode).decode(None, None, *args, **keywds)
+    del keywds['sequenceA'], keywds['sequenceB']
+
+    if workers == 1:
+        _init_batch(keywds)
+        for index, result in itertools.imap(_align_pair, enumerate(pairs)):
+            yield result if ordered else (index, result)
+        return
+
+    indexed_pairs = enumerate(pairs)
+    chunks = iter(lambda: list(itertools.islice(indexed_pairs, chunksize)), [])
+    pool = multiprocessing.Pool(workers, _init_batch, (keywds,))
+    try:
+        # results of chunks sent to workers, in order of pairs
+        in_flight = collections.deque()
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                in_flight.append(pool.apply_async(_align_chunk, (chunk,)))
+            while in_flight and (chunk is None or len(in_flight) >= max_in_flight):
+                # unordered results are taken from a computed chunk, or the first chunk if none is computed yet
+                chunk_results = in_flight[0] if ordered else next(
+                    (computed for computed in in_flight if computed.ready()), in_flight[0])
+                in_flight.remove(chunk_results)
+                for index, result in chunk_results.get():
+                    yield result if ordered else (index, result)
+    finally:
+        pool.terminate()
+
+
+def _score_window(pairs):
+    """Return scores of pairs in worker process, with arguments set by _init_batch.
+       Pairs of short strings are aligned in batches by numpy engine. Pairs with longer sequence A are swapped,
+       as their scores are the same in transposed matrices, and sorted by lengths, so that pairs of a batch
+       have similar lengths and little padding."""
+    keywds = dict(_batch_keywds)
+    batch_size = keywds.pop('batch_size')
+    max_cells = IDENTITY_MATCH_BATCH_MAX_CELLS if isinstance(keywds['match_fn'], pairwise2.identity_match) \
+        else SHORT_PAIR_MAX_LENGTH ** 2
+    scores = [None] * len(pairs)
+    short = []
+    for index, (sequenceA, sequenceB) in enumerate(pairs):
+        if not isinstance(sequenceA, list) and not isinstance(sequenceB, list):
+            sequenceA, sequenceB = str(sequenceA), str(sequenceB)
+            if 0 < len(sequenceA) <= SHORT_PAIR_MAX_LENGTH and 0 < len(sequenceB) <= SHORT_PAIR_MAX_LENGTH and \
+                    len(sequenceA) * len(sequenceB) <= max_cells:
+                if len(sequenceA) <= len(sequenceB):
+                    short.append((False, len(sequenceA), len(sequenceB), index, sequenceA, sequenceB))
+                else:
+                    short.append((True, len(sequenceB), len(sequenceA), index, sequenceB, sequenceA))
+                continue
+        scores[index] = _align(sequenceA=sequenceA, sequenceB=sequenceB, **keywds)
+    short.sort()
+
+    gap_A_fn, gap_B_fn = keywds['gap_A_fn'], keywds['gap_B_fn']
+    arguments = (keywds['match_fn'], gap_A_fn.open, gap_A_fn.extend, gap_B_fn.open, gap_B_fn.extend,
+                 keywds['penalize_extend_when_opening'], keywds['penalize_end_gaps'])
+    swapped_arguments = (numpy_engine._swapped_arguments(keywds['match_fn']), gap_B_fn.open, gap_B_fn.extend,
+                         gap_A_fn.open, gap_A_fn.extend, keywds['penalize_extend_when_opening'],
+                         keywds['penalize_end_gaps'][::-1])
+    stats = profiling.current()
+    for swapped, group in itertools.groupby(short, lambda pair: pair[0]):
+        group = list(group)
+        for start in xrange(0, len(group), batch_size):
+            batch = group[start:start + batch_size]
+            # each pair is counted as a call, as when aligned alone
+            stats.start(len(batch))
+            stats.add_cells(sum(lenA * lenB for _, lenA, lenB, _, _, _ in batch))
+            stats.mark('preparation')
+            batch_scores = numpy_engine.compute_scores(
+                [(shorter, longer) for _, _, _, _, shorter, longer in batch],
+                *(swapped_arguments if swapped else arguments), align_globally=keywds['align_globally'])
+            stats.mark('matrix_fill')
+            for (_, _, _, index, _, _), score in itertools.izip(batch, batch_scores):
+                scores[index] = score
+    return scores
+
+def _score_each(pairs):
+    """Return scores of pairs in worker process, aligning them one by one."""
+    keywds = dict(_batch_keywds)
+    del keywds['batch_size']
+    return [_align(sequenceA=sequenceA, sequenceB=sequenceB, **keywds) for sequenceA, sequenceB in pairs]
+
+def _score_arguments(mode, args, keywds):
+    """Return arguments of _align decoded for scores of a batch (without sequences, with batch_size),
+       and function computing scores of a list of pairs in worker process (_score_window or _score_each)."""
+    batch_size = keywds.pop('batch_size', 256)
+    keywds.pop('score_only', None)
+    keywds = align.alignment_function(mode).decode(None, None, *args, score_only=True, **keywds)
+    del keywds['sequenceA'], keywds['sequenceB']
+    keywds['batch_size'] = batch_size
+    batched = numpy_engine is not None and not keywds['force_generic'] and \
+        isinstance(keywds['gap_A_fn'], pairwise2.affine_penalty) and \
+        isinstance(keywds['gap_B_fn'], pairwise2.affine_penalty) and \
+        keywds.get('engine', 'auto') in ('auto', 'numpy') and \
+        all(keywds.get(name) is None for name in ('band', 'min_score', 'xdrop'))
+    return keywds, (_score_window if batched else _score_each)
+
+def score_many(pairs, mode, *args, **keywds):
+    """Compute scores of many pairs of sequences with same method, as align.<mode>(..., score_only=True).
+
+       Arguments are as in align_many, scores are yielded in order of pairs. Additional keyword argument
+       batch_size (default: 256) is the number of pairs of strings not longer than SHORT_PAIR_MAX_LENGTH
+       aligned at once by numpy engine, which fills matrices of all pairs of a batch together.
+       This avoids the cost of Python code of every single alignment, which is bigger than the cost
+       of filling matrices of short sequences. Pairs are read in windows of 8 batches and aligned in batches
+       of similar lengths. Other pairs, and all pairs of other methods than affine gap penalties on engines
+       'auto' and 'numpy', are aligned one by one."""
+    import multiprocessing
+    workers = keywds.pop('workers', None) or multiprocessing.cpu_count()
+    keywds, score_window = _score_arguments(mode, args, keywds)
+
+    pairs = iter(pairs)
+    windows = iter(lambda: list(itertools.islice(pairs, 8 * keywds['batch_size'])), [])
+    if workers == 1:
+        _init_batch(keywds)
+        results = itertools.imap(score_window, windows)
+    else:
+        pool = multiprocessing.Pool(workers, _init_batch, (keywds,))
+        results = pool.imap(score_window, windows)
+    try:
+        for scores in results:
+            for score in scores:
+                yield score
+    finally:
+        if workers != 1:
+            pool.terminate()
+
+
+def search(query, database_iter, mode, *args, **keywds):
+    """Find target sequences with the best alignment scores with query.
+
+       mode is a name of alignment method, e.g. 'localds', args and keywds are passed to it as in align.<mode>,
+       without sequences. Keyword argument top_k (default: 10) is the number of returned targets.
+       Query is encoded once, with a profile of match scores reused for all targets, and only scores are computed
+       during the scan. Returns list of tuples (index of target, score, alignments), the best scores first,
+       alignments are recovered only for these targets. With score_only=True tuples (index, score) are returned.
+       Empty targets and targets not reaching min_score (or dropped by xdrop) are skipped."""
+    top_k = keywds.pop('top_k', 10)
+    score_only = keywds.pop('score_only', False)
+    keywds = align.alignment_function(mode).decode(query, None, *args, **keywds)
+    del keywds['sequenceB'], keywds['score_only']
+    if not query:
+        return []
+    compute_score = _search_score_function(**keywds)
+
+    # min-heap of (score, -index, target), so that the worst of top targets is popped first
+    heap = []
+    for index, target in enumerate(database_iter):
+        if not target:
+            continue
+        item = (compute_score(target), -index, target)
+        if item[0] is None:
+            continue
+        if len(heap) < top_k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    best = sorted(heap, reverse=True)
+    if score_only:
+        return [(-index, score) for score, index, _ in best]
+    return [(-index, score, _align(sequenceB=target, score_only=False, **keywds)) for score, index, target in best]
+
+def _search_score_function(sequenceA, match_fn, gap_A_fn, gap_B_fn, penalize_extend_when_opening,
+                           penalize_end_gaps, align_globally, force_generic, engine='auto', **keywds):
+    """Return function computing score of alignment of sequenceA with given target sequence.
+       Query profile is used when match function would be called for every cell otherwise.
+       Scores are bounded by min_score and xdrop as in _align."""
+    if not isinstance(sequenceA, list):
+        sequenceA = str(sequenceA)
+    if (numpy_engine is None or force_generic or engine not in ('auto', 'numpy') or
+            not isinstance(gap_A_fn, pairwise2.affine_penalty) or not isinstance(gap_B_fn, pairwise2.affine_penalty) or
+            (isinstance(match_fn, pairwise2.identity_match) and not isinstance(sequenceA, list))):
+        return lambda target: _align(sequenceA, target, match_fn, gap_A_fn, gap_B_fn, penalize_extend_when_opening,
+                                     penalize_end_gaps, align_globally, force_generic=force_generic,
+                                     score_only=True, engine=engine, **keywds)
+    min_score, xdrop = keywds.get('min_score'), keywds.get('xdrop')
+    if xdrop is not None and align_globally:
+        raise ValueError('xdrop can be used only with local alignments')
+    profile = numpy_engine.QueryProfile(sequenceA, match_fn)
+
+    def compute_score(target):
+        if not isinstance(target, list):
+            target = str(target)
+        return numpy_engine.compute_score(
+            sequenceA, target, match_fn, gap_A_fn.open, gap_A_fn.extend, gap_B_fn.open, gap_B_fn.extend,
+            penalize_extend_when_opening, penalize_end_gaps, align_globally, profile=profile,
+            min_score=min_score, xdrop=xdrop)
+    return compute_score
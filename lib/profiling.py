@@ -0,0 +1,137 @@
+"""Per-stage profiling of alignments computed by optimized_pairwise2.
+
+Time of stages (preparation, matrix fill, finding starts, traceback) and counters of calls, filled cells
+and recovered alignments are collected per thread. Profiling is enabled in current thread with:
+
+    with profiling.profile() as stats:
+        optimized_pairwise2.align.globalxx(seqA, seqB)
+    print(stats.as_dict())
+
+or in all threads, when environment variable OPTIMIZED_PAIRWISE2_PROFILE is set to a non-zero value,
+in which case stats of all threads are summed by collect(). When disabled, stages are marked on a shared
+object doing nothing.
+"""
+import contextlib
+import os
+import threading
+from timeit import default_timer as timer
+
+ENVIRONMENT_VARIABLE = 'OPTIMIZED_PAIRWISE2_PROFILE'
+
+STAGES = ('preparation', 'matrix_fill', 'find_starts', 'traceback')
+
+
+class StageStats(object):
+    """Seconds spent in each stage and counters of alignment calls, filled cells and recovered alignments."""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.calls = self.cells = self.alignments = 0
+        self._last = None
+
+    def start(self, calls=1):
+        """Count a call (or given number of calls computed together) and start timing its first stage."""
+        self.calls += calls
+        self._last = timer()
+
+    def mark(self, stage):
+        """Add time since start or previous mark to given stage."""
+        now = timer()
+        self.seconds[stage] += now - self._last
+        self._last = now
+
+    def add_cells(self, cells):
+        self.cells += cells
+
+    def add_alignments(self, alignments):
+        self.alignments += alignments
+
+    def merge(self, other):
+        """Add times and counters of other stats."""
+        for stage, seconds in other.seconds.iteritems():
+            self.seconds[stage] += seconds
+        self.calls += other.calls
+        self.cells += other.cells
+        self.alignments += other.alignments
+
+    def as_dict(self):
+        return {'seconds': dict(self.seconds), 'calls': self.calls, 'cells': self.cells,
+                'alignments': self.alignments}
+
+
+class _DisabledStats(object):
+    """Stats object used when profiling is disabled, all its methods do nothing."""
+
+    def start(self, calls=1):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def add_cells(self, cells):
+        pass
+
+    def add_alignments(self, alignments):
+        pass
+
+_DISABLED = _DisabledStats()
+
+_local = threading.local()
+# stats of all threads profiled because of environment variable
+_threads_stats = []
+_threads_stats_lock = threading.Lock()
+
+
+def enabled_by_environment():
+    return os.environ.get(ENVIRONMENT_VARIABLE, '0') not in ('', '0')
+
+_enabled_by_environment = enabled_by_environment()
+
+
+def current():
+    """Return stats collecting profile of current thread, or an object doing nothing if profiling is disabled."""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        return stack[-1]
+    if _enabled_by_environment:
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            stats = _local.stats = StageStats()
+            with _threads_stats_lock:
+                _threads_stats.append(stats)
+        return stats
+    return _DISABLED
+
+
+@contextlib.contextmanager
+def profile():
+    """Context manager profiling alignments in current thread, yields StageStats.
+       Stats of nested profiles are added to the outer ones when they end."""
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stats = StageStats()
+    stack.append(stats)
+    try:
+        yield stats
+    finally:
+        stack.pop()
+        if stack:
+            stack[-1].merge(stats)
+
+
+def collect():
+    """Return sum of stats of all threads profiled because of environment variable."""
+    total = StageStats()
+    with _threads_stats_lock:
+        for stats in _threads_stats:
+            total.merge(stats)
+    return total
+
+
+def reset():
+    """Clear stats of all threads profiled because of environment variable."""
+    with _threads_stats_lock:
+        for stats in _threads_stats:
+            stats.seconds = dict.fromkeys(STAGES, 0.0)
+            stats.calls = stats.cells = stats.alignments = 0
@@ -0,0 +1,242 @@
+""" Headless benchmarks of alignment methods. For comparing performance between engines and versions of our code.
+
+Every method of unit tests is run on generated samples of given lengths, alphabets and similarities,
+by original Bio.pairwise2 and by our code with each engine. Median and 95th percentile of latency, throughput
+and peak memory are written as JSON, which can be compared with results of a previous run (--baseline).
+Startup time (import of our code and first alignments) is measured in fresh interpreters. """
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+from timeit import default_timer as timer
+import numpy
+import Bio
+from Bio import pairwise2
+from lib import optimized_pairwise2
+from run_unittests import AlignmentsEquivalenceTestCase
+import generate_samples
+
+ALPHABETS = {
+    "dna": "ACGT",
+    "protein": generate_samples.PROTEIN_ALPHABET,
+}
+
+""" Name of original code in results, other implementations are engines of our code """
+ORIGINAL = "Bio.pairwise2"
+
+""" Statements timed in fresh interpreters, as first things done by a program using our code """
+STARTUP_CASES = [
+    ("import", "from lib import optimized_pairwise2"),
+    ("first alignment", "from lib import optimized_pairwise2\n"
+                        "optimized_pairwise2.align.globalms('GATTACA', 'GCATGCT', 2, -1, -.5, -.1)"),
+    ("first score", "from lib import optimized_pairwise2\n"
+                    "optimized_pairwise2.align.globalms('GATTACA', 'GCATGCT', 2, -1, -.5, -.1, score_only=True)"),
+    ("first numpy alignment", "from lib import optimized_pairwise2\n"
+                              "optimized_pairwise2.align.globalms('GATTACA', 'GCATGCT', 2, -1, -.5, -.1, "
+                              "engine='numpy')"),
+    ("import pipeline", "from lib import align_pipeline"),
+]
+
+
+def implementations():
+    """ Returns names of all benchmarked implementations """
+    return [ORIGINAL, "auto"] + sorted(optimized_pairwise2.SCORE_MATRIX_ENGINES)
+
+
+def current_rss_kb():
+    """ Returns resident set size of this process in kilobytes (peak size, if current one is not known) """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(sorted_values, p):
+    """ Returns p-th percentile (nearest rank) of sorted values """
+    return sorted_values[max(int(math.ceil(p / 100.0 * len(sorted_values))) - 1, 0)]
+
+
+def measure(implementation, method_name, args, kwargs, seq1, seq2, repeats):
+    """ Runs alignment method repeatedly, returns tuple (times in seconds, peak memory growth in kilobytes).
+        Called in a fresh process for each case, so that peak memory of one case does not hide others. """
+    rss_start = current_rss_kb()
+    if implementation == ORIGINAL:
+        method = pairwise2.align.__getattr__(method_name)
+    else:
+        method = optimized_pairwise2.align.__getattr__(method_name)
+        kwargs = dict(kwargs, engine=implementation)
+    times = []
+    for _ in xrange(repeats):
+        start = timer()
+        method(seq1, seq2, *args, **kwargs)
+        times.append(timer() - start)
+    return times, max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start, 0)
+
+
+def generate_benchmark_samples(lengths, alphabets, similarities, seed):
+    """ Returns list of tuples (alphabet name, length, similarity, seq1, seq2), same for same seed """
+    random.seed(seed)
+    numpy.random.seed(seed)
+    return [(alphabet, length, similarity) +
+            generate_samples.generate_sample(ALPHABETS[alphabet], length, similarity)
+            for alphabet in alphabets for length in lengths for similarity in similarities]
+
+
+def run_benchmarks(samples, methods, implementations, repeats, score_only_values, kwargs):
+    """ Returns list of results (dictionaries) of all combinations of samples, methods and implementations """
+    results = []
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for alphabet, length, similarity, seq1, seq2 in samples:
+            for method_name, args in methods:
+                for score_only in score_only_values:
+                    for implementation in implementations:
+                        result = {"method": method_name, "score_only": score_only, "alphabet": alphabet,
+                                  "length": length, "similarity": similarity, "implementation": implementation,
+                                  "lengths": [len(seq1), len(seq2)], "repeats": repeats}
+                        case_kwargs = dict(kwargs, score_only=score_only)
+                        try:
+                            times, memory = pool.apply(measure, (implementation, method_name, args, case_kwargs,
+                                                                 seq1, seq2, repeats))
+                        except Exception as e:
+                            result["error"] = repr(e)
+                        else:
+                            times.sort()
+                            median = percentile(times, 50)
+                            result.update({
+                                "median_ms": median * 1000, "p95_ms": percentile(times, 95) * 1000,
+                                "pairs_per_second": 1 / median if median else None,
+                                "cells_per_second": len(seq1) * len(seq2) / median if median else None,
+                                "peak_memory_kb": memory})
+                        sys.stderr.write("{method} score_only={score_only} {alphabet} length={length} "
+                                         "similarity={similarity} {implementation}: {0}\n".format(
+                                             result.get("error") or "%.2f ms" % result["median_ms"], **result))
+                        results.append(result)
+    finally:
+        pool.terminate()
+    return results
+
+
+def measure_startup(statement, repeats):
+    """ Runs statement in fresh interpreters, returns tuple (times of statement, times of whole processes) """
+    code = "from timeit import default_timer as timer\nstart = timer()\n{0}\nprint(timer() - start)".format(statement)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times, process_times = [], []
+    for _ in xrange(repeats):
+        start = timer()
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=directory)
+        process_times.append(timer() - start)
+        times.append(float(output.split()[-1]))
+    return times, process_times
+
+
+def run_startup_benchmarks(repeats):
+    """ Returns list of results (dictionaries) of startup cases """
+    results = []
+    for name, statement in STARTUP_CASES:
+        result = {"startup": name, "statement": statement, "repeats": repeats}
+        try:
+            times, process_times = measure_startup(statement, repeats)
+        except (subprocess.CalledProcessError, ValueError) as e:
+            result["error"] = repr(e)
+        else:
+            times.sort()
+            process_times.sort()
+            result.update({"median_ms": percentile(times, 50) * 1000, "p95_ms": percentile(times, 95) * 1000,
+                           "process_median_ms": percentile(process_times, 50) * 1000})
+        sys.stderr.write("startup {0}: {1}\n".format(name, result.get("error") or "%.2f ms" % result["median_ms"]))
+        results.append(result)
+    return results
+
+
+def case_key(result):
+    """ Returns key identifying benchmark case of a result, for comparing runs """
+    if "startup" in result:
+        return ("startup", result["startup"])
+    return tuple(result[k] for k in ("method", "score_only", "alphabet", "length", "similarity", "implementation"))
+
+
+def compare_results(results, baseline, tolerance):
+    """ Returns list of tuples (case key, baseline median, median) of cases which are slower than in baseline
+        by more than tolerance (e.g. 0.1 for 10%) """
+    baseline_medians = dict((case_key(r), r["median_ms"]) for r in baseline if "median_ms" in r)
+    regressions = []
+    for result in results:
+        key = case_key(result)
+        if "median_ms" in result and key in baseline_medians:
+            if result["median_ms"] > baseline_medians[key] * (1 + tolerance):
+                regressions.append((key, baseline_medians[key], result["median_ms"]))
+    return regressions
+
+
+def environment():
+    """ Returns description of environment in which benchmarks are run """
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": multiprocessing.cpu_count(), "biopython": Bio.__version__, "numpy": numpy.__version__}
+
+
+def parse_arguments(argv):
+    method_names = [m for m, _ in AlignmentsEquivalenceTestCase.test_cases]
+    parser = argparse.ArgumentParser(description="Run benchmarks of alignment methods, write results as JSON.")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 500], help="lengths of generated samples")
+    parser.add_argument("--alphabets", nargs="+", choices=sorted(ALPHABETS), default=sorted(ALPHABETS))
+    parser.add_argument("--similarities", type=float, nargs="+", default=[0.9, 0.5],
+                        help="chances of keeping symbols unchanged in second sequence of samples")
+    parser.add_argument("--methods", nargs="+", choices=method_names, default=method_names)
+    parser.add_argument("--implementations", nargs="+", choices=implementations(), default=implementations())
+    parser.add_argument("--score-only", choices=["yes", "no", "both"], default="both",
+                        help="benchmark score computation, alignments or both (default)")
+    parser.add_argument("--one-alignment-only", action="store_true", help="recover only one alignment")
+    parser.add_argument("--repeats", type=int, default=5, help="runs of each case (default: 5)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of generated samples (default: 0)")
+    parser.add_argument("--output", "-o", default="-", help="JSON output file (default: '-', standard output)")
+    parser.add_argument("--baseline", help="JSON results of a previous run, slower cases are reported")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative slowdown reported as regression (default: 0.1)")
+    parser.add_argument("--startup-repeats", type=int, default=10,
+                        help="fresh interpreters started for each startup case (default: 10, 0 skips them)")
+    parser.add_argument("--startup-only", action="store_true", help="measure only startup time")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_arguments(argv)
+    methods = [(m, args) for m, args in AlignmentsEquivalenceTestCase.test_cases if m in options.methods]
+    score_only_values = {"yes": [True], "no": [False], "both": [True, False]}[options.score_only]
+    kwargs = {"one_alignment_only": True} if options.one_alignment_only else {}
+
+    results = []
+    if not options.startup_only:
+        samples = generate_benchmark_samples(options.lengths, options.alphabets, options.similarities, options.seed)
+        results = run_benchmarks(samples, methods, options.implementations, options.repeats, score_only_values,
+                                 kwargs)
+    startup = run_startup_benchmarks(options.startup_repeats) if options.startup_repeats > 0 else []
+    report = {"environment": environment(), "parameters": vars(options), "results": results, "startup": startup}
+
+    output = sys.stdout if options.output == "-" else open(options.output, "w")
+    json.dump(report, output, indent=1, sort_keys=True)
+    output.write("\n")
+    if output is not sys.stdout:
+        output.close()
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results + startup, baseline["results"] + baseline.get("startup", []),
+                                      options.tolerance)
+        for key, baseline_median, median in regressions:
+            sys.stderr.write("Regression: {0}: {1:.2f} ms -> {2:.2f} ms\n".format(key, baseline_median, median))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
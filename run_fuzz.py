@@ -0,0 +1,337 @@
+""" Randomized differential tests of our alignment methods against original Bio.pairwise2.
+
+Cases are generated by generate_samples for random alphabets and lengths, with edge cases (empty and one letter
+sequences, lists, custom gap characters), for every alignment mode (global/local, match codes x, m, d, c and
+gap codes x, s, d, c) with random parameters and keyword arguments. Result of each case (alignments, score
+or type of raised error) is compared between Bio.pairwise2 and every engine and variant of our code
+(checkpointed matrices, band, spill, lazy alignments, score_many). Case i of a seed is always the same, so a failure
+is reproduced with --seed and --case. Time of each implementation is written as JSON, which can be compared
+with results of a previous run (--baseline), so that the harness is also a gate of performance regressions. """
+
+import argparse
+import itertools
+import json
+import math
+import platform
+import random
+import signal
+import sys
+from timeit import default_timer as timer
+import numpy
+import Bio
+from Bio import pairwise2
+from Bio.SubsMat.MatrixInfo import blosum62
+from lib import optimized_pairwise2
+import generate_samples
+
+ALPHABETS = {
+    "binary": "AC",
+    "dna": "ACGT",
+    "protein": generate_samples.PROTEIN_ALPHABET,
+}
+
+""" Name of original code in results, other implementations are variants of our code """
+ORIGINAL = "Bio.pairwise2"
+
+MATCH_CODES = "xmdc"
+GAP_CODES = "xsdc"
+
+""" Keyword arguments of all modes with their tested values """
+KEYWORD_ARGUMENTS = [
+    ("penalize_extend_when_opening", [False, True]),
+    ("penalize_end_gaps", [True, False, (True, False), (False, True)]),
+    ("one_alignment_only", [False, True]),
+    ("score_only", [False, True]),
+    ("force_generic", [False, True]),
+]
+
+MATCH_SCORES = [1, 2, 3, 5, 1.5]
+MISMATCH_SCORES = [0, -1, -2, -4, -0.5]
+OPEN_PENALTIES = [0, -0.5, -1, -2, -3, -5, -10]
+EXTEND_PENALTIES = [0, -0.1, -0.5, -1, -2]
+
+
+def callback_match(a, b):
+    """ Match function of mode code 'c' """
+    return 3 if a == b else -1 - (a < b)
+
+
+def linear_gap(index, length):
+    """ Gap function of mode code 'c', same as affine penalty with open -2 and extend -1 """
+    return -1 - length
+
+
+def logarithmic_gap(index, length):
+    """ Gap function of mode code 'c', penalty depending on position of gap """
+    return -2 - math.log(length + 1) - (index % 3 == 0)
+
+
+GAP_FUNCTIONS = [linear_gap, logarithmic_gap]
+
+
+class CaseTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise CaseTimeout()
+
+
+def call_with_time_limit(seconds, function, *args, **kwargs):
+    """ Returns result of function, raises CaseTimeout if it takes more than given seconds.
+        Without SIGALRM (e.g. on Windows) time is not limited. """
+    if not seconds or not hasattr(signal, "setitimer"):
+        return function(*args, **kwargs)
+    previous = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def result_or_error(function, *args, **kwargs):
+    """ Returns result of alignment function (lazy results as a list) or name of type of raised error """
+    try:
+        result = function(*args, **kwargs)
+        if kwargs.get("lazy"):
+            result = list(result)
+        return result
+    except CaseTimeout:
+        raise
+    except Exception as e:
+        return type(e).__name__
+
+
+def random_match_dictionary(alphabet):
+    """ Returns random scores of pairs of symbols, of all pairs or only one of (a, b) and (b, a) """
+    half = random.random() < 0.5
+    return dict(((a, b), random.choice(MATCH_SCORES if a == b else MISMATCH_SCORES))
+                for a in alphabet for b in alphabet if not half or a <= b)
+
+
+def generate_arguments(match_code, gap_code, alphabet):
+    """ Returns random arguments of alignment mode with given codes """
+    if match_code == "m":
+        args = [random.choice(MATCH_SCORES), random.choice(MISMATCH_SCORES)]
+    elif match_code == "d":
+        use_blosum = alphabet == generate_samples.PROTEIN_ALPHABET and random.random() < 0.5
+        args = [blosum62 if use_blosum else random_match_dictionary(alphabet)]
+    elif match_code == "c":
+        args = [callback_match]
+    else:
+        args = []
+    # opening penalty is usually not higher than extension penalty, which is rejected by Bio.pairwise2
+    for _ in xrange({"s": 1, "d": 2}.get(gap_code, 0)):
+        open_penalty, extend_penalty = random.choice(OPEN_PENALTIES), random.choice(EXTEND_PENALTIES)
+        if random.random() < 0.9:
+            open_penalty = min(open_penalty, extend_penalty)
+        args += [open_penalty, extend_penalty]
+    if gap_code == "c":
+        args += [random.choice(GAP_FUNCTIONS), random.choice(GAP_FUNCTIONS)]
+    return args
+
+
+def generate_sequences(alphabet, max_length):
+    """ Returns tuple (seq1, seq2, gap_char) of a random sample or an edge case """
+    kind = random.random()
+    if kind < 0.05:
+        seq1, seq2 = "", generate_samples.generate_sample(alphabet, random.randint(0, 5))[0]
+    elif kind < 0.1:
+        seq1, seq2 = random.choice(alphabet), generate_samples.generate_sample(alphabet, random.randint(1, 8))[0]
+    elif kind < 0.15:
+        seq1 = seq2 = generate_samples.generate_sample(alphabet, random.randint(1, max_length))[0]
+    else:
+        seq1, seq2 = generate_samples.generate_sample(alphabet, random.randint(1, max_length))
+    if random.random() < 0.5:
+        seq1, seq2 = seq2, seq1
+    kind = random.random()
+    if kind < 0.2:
+        return list(seq1), list(seq2), ["-"]
+    if kind < 0.3:
+        return seq1, seq2, random.choice("._")
+    return seq1, seq2, "-"
+
+
+def generate_case(seed, index, max_length, alphabets, all_keywords=False):
+    """ Returns case (dictionary) of given index, same for same seed, index and other arguments """
+    random.seed((seed, index))
+    numpy.random.seed(random.randint(0, 2 ** 32 - 1))
+    alphabet = ALPHABETS[random.choice(alphabets)]
+    mode = random.choice(["global", "local"]) + random.choice(MATCH_CODES) + random.choice(GAP_CODES)
+    args = generate_arguments(mode[-2], mode[-1], alphabet)
+    seq1, seq2, gap_char = generate_sequences(alphabet, max_length)
+    if all_keywords:
+        kwargs_list = [dict(values) for values in itertools.product(
+            *[[(name, value) for value in values] for name, values in KEYWORD_ARGUMENTS])]
+    else:
+        kwargs_list = [dict((name, random.choice(values)) for name, values in KEYWORD_ARGUMENTS)]
+    for kwargs in kwargs_list:
+        kwargs["gap_char"] = gap_char
+    return {"index": index, "mode": mode, "args": args, "seq1": seq1, "seq2": seq2, "kwargs_list": kwargs_list}
+
+
+def _score_many(method_name):
+    def score(seq1, seq2, *args, **kwargs):
+        return list(optimized_pairwise2.score_many([(seq1, seq2)], method_name, *args, workers=1, **kwargs))[0]
+    return score
+
+
+def variants(mode, kwargs):
+    """ Returns list of tuples (name, alignment function, additional keyword arguments) compared with original
+        code for given mode and keyword arguments """
+    method = optimized_pairwise2.align.__getattr__(mode)
+    result = [("engine=" + engine, method, {"engine": engine})
+              for engine in ["auto"] + sorted(optimized_pairwise2.SCORE_MATRIX_ENGINES)]
+    if "numpy" in optimized_pairwise2.SCORE_MATRIX_ENGINES:
+        if kwargs["one_alignment_only"]:
+            result.append(("checkpointed", method, {"engine": "numpy", "checkpointed": True}))
+        if mode.startswith("global"):
+            result.append(("band", method, {"band": 4}))
+        if not kwargs["score_only"] and not kwargs["force_generic"] and mode[-1] != "c":
+            # only matrices of affine gap penalties are spilled
+            result.append(("spill", method, {"spill": True}))
+    if not kwargs["score_only"]:
+        result.append(("lazy", method, {"lazy": True}))
+    else:
+        result.append(("score_many", _score_many(mode), {}))
+    return result
+
+
+def describe(value, limit=200):
+    """ Returns JSON serializable description of an argument or a result """
+    if callable(value):
+        return getattr(value, "__name__", repr(value))
+    if value is blosum62:
+        return "blosum62"
+    text = repr(value)
+    return text if len(text) <= limit else text[:limit] + "..."
+
+
+def run_case(case, timings, case_timeout):
+    """ Compares results of case between original code and all variants, adds time of each implementation
+        to timings (dictionary of name: [seconds, calls]). Returns tuple (list of failures, skipped) """
+    failures = []
+    method = pairwise2.align.__getattr__(case["mode"])
+    for kwargs in case["kwargs_list"]:
+        start = timer()
+        try:
+            expected = call_with_time_limit(case_timeout, result_or_error, method, case["seq1"], case["seq2"],
+                                            *case["args"], **kwargs)
+        except CaseTimeout:
+            return failures, True
+        reference_time = timer() - start
+        timings.setdefault(ORIGINAL, [0.0, 0])
+        timings[ORIGINAL][0] += reference_time
+        timings[ORIGINAL][1] += 1
+        for name, function, variant_kwargs in variants(case["mode"], kwargs):
+            start = timer()
+            try:
+                result = call_with_time_limit(case_timeout + 10 * reference_time, result_or_error, function,
+                                              case["seq1"], case["seq2"], *case["args"],
+                                              **dict(kwargs, **variant_kwargs))
+            except CaseTimeout:
+                result = "CaseTimeout"
+            timings.setdefault(name, [0.0, 0])
+            timings[name][0] += timer() - start
+            timings[name][1] += 1
+            if result != expected:
+                failures.append({"case": case["index"], "mode": case["mode"], "variant": name,
+                                 "args": [describe(arg) for arg in case["args"]],
+                                 "kwargs": dict((k, describe(v)) for k, v in kwargs.iteritems()),
+                                 "seq1": describe(case["seq1"]), "seq2": describe(case["seq2"]),
+                                 "expected": describe(expected), "result": describe(result)})
+    return failures, False
+
+
+def run_fuzz(seed, count, max_length, alphabets, all_keywords=False, case_timeout=10, cases=None, verbose=False):
+    """ Runs generated cases (given indexes, or the first count ones), returns dictionary with failures,
+        timings of implementations and indexes of skipped cases (original code took longer than case_timeout) """
+    failures, skipped, timings = [], [], {}
+    for index in (cases if cases is not None else xrange(count)):
+        case = generate_case(seed, index, max_length, alphabets, all_keywords)
+        case_failures, case_skipped = run_case(case, timings, case_timeout)
+        failures.extend(case_failures)
+        if case_skipped:
+            skipped.append(index)
+        if verbose:
+            sys.stderr.write("case {0} {1} lengths {2}, {3}: {4}\n".format(
+                index, case["mode"], len(case["seq1"]), len(case["seq2"]),
+                "skipped" if case_skipped else "%d failures" % len(case_failures)))
+    timings = [{"implementation": name, "seconds": seconds, "calls": calls}
+               for name, (seconds, calls) in sorted(timings.iteritems())]
+    return {"failures": failures, "skipped": skipped, "timings": timings}
+
+
+def compare_timings(timings, baseline, tolerance):
+    """ Returns list of tuples (implementation, baseline seconds, seconds) of implementations which are slower
+        than in baseline by more than tolerance (e.g. 0.25 for 25%) """
+    baseline_seconds = dict((t["implementation"], t["seconds"]) for t in baseline)
+    return [(t["implementation"], baseline_seconds[t["implementation"]], t["seconds"]) for t in timings
+            if t["implementation"] in baseline_seconds and
+            t["seconds"] > baseline_seconds[t["implementation"]] * (1 + tolerance)]
+
+
+def environment():
+    """ Returns description of environment in which cases are run """
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "biopython": Bio.__version__, "numpy": numpy.__version__}
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Compare random alignments of our code with Bio.pairwise2.")
+    parser.add_argument("--seed", type=int, default=0, help="seed of generated cases (default: 0)")
+    parser.add_argument("--cases", type=int, default=200, help="number of generated cases (default: 200)")
+    parser.add_argument("--case", type=int, nargs="+", help="run only cases of given indexes")
+    parser.add_argument("--max-length", type=int, default=60, help="maximal length of sequences (default: 60)")
+    parser.add_argument("--alphabets", nargs="+", choices=sorted(ALPHABETS), default=sorted(ALPHABETS))
+    parser.add_argument("--all-keywords", action="store_true",
+                        help="run each case with all combinations of keyword arguments, instead of random ones")
+    parser.add_argument("--case-timeout", type=float, default=10,
+                        help="seconds after which a case is skipped, if original code has not finished it "
+                             "(e.g. enumerating too many alignments), 0 for no limit (default: 10)")
+    parser.add_argument("--output", "-o", default="-", help="JSON output file (default: '-', standard output)")
+    parser.add_argument("--baseline", help="JSON results of a previous run with same cases, slower "
+                                           "implementations are reported")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative slowdown reported as regression (default: 0.25)")
+    parser.add_argument("--verbose", "-v", action="store_true", help="report each case to standard error")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_arguments(argv)
+    start = timer()
+    report = run_fuzz(options.seed, options.cases, options.max_length, options.alphabets, options.all_keywords,
+                      options.case_timeout, options.case, options.verbose)
+    report.update({"environment": environment(), "parameters": vars(options), "seconds": timer() - start})
+
+    output = sys.stdout if options.output == "-" else open(options.output, "w")
+    json.dump(report, output, indent=1, sort_keys=True)
+    output.write("\n")
+    if output is not sys.stdout:
+        output.close()
+
+    for failure in report["failures"]:
+        sys.stderr.write("Failure: case {case} {mode} {variant}: expected {expected}, got {result}\n".format(
+            **failure))
+    sys.stderr.write("{0} cases, {1} failures, {2} skipped\n".format(
+        len(options.case) if options.case else options.cases, len(report["failures"]), len(report["skipped"])))
+    failed = bool(report["failures"])
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline["parameters"]["seed"] != options.seed or baseline["parameters"]["cases"] != options.cases:
+            sys.stderr.write("Warning: baseline was run with other cases\n")
+        regressions = compare_timings(report["timings"], baseline["timings"], options.tolerance)
+        for implementation, baseline_seconds, seconds in regressions:
+            sys.stderr.write("Regression: {0}: {1:.3f} s -> {2:.3f} s\n".format(
+                implementation, baseline_seconds, seconds))
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,69 @@ It is a very important requirement to make our version of library is interchange
 """
 import unittest
 import itertools
+import functools
+import gc
+import httplib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 from timeit import default_timer as timer
 from Bio import pairwise2
+from Bio.SubsMat.MatrixInfo import blosum62
 from lib import optimized_pairwise2 as opt_pairwise2
+from lib import align_pipeline
+from lib import align_service
+from lib import all_vs_all
+from lib.alignment_cache import AlignmentCache
+from lib import profiling
 from testdata.test_sequences import get_test_sequences_pairs, all_equal
+import run_fuzz
+
+
+def align_or_error(method, *args, **kwargs):
+    """ Returns result of alignment method or type of raised error (e.g. KeyError for symbol missing in a matrix) """
+    try:
+        return method(*args, **kwargs)
+    except KeyError as e:
+        return type(e)
+
+
+# Results of Bio.pairwise2 for the last aligned pair of sequences, by method and arguments
+_original_results = {}
+
+# Default keyword arguments of alignment methods, so that results of same arguments are computed once
+# (penalize_end_gaps defaults to True only for global alignments)
+DEFAULT_KEYWORD_ARGUMENTS = {"penalize_extend_when_opening": False, "one_alignment_only": False,
+                             "score_only": False}
+
+
+def original_result(method_name, seq1, seq2, *args, **kwargs):
+    """ Returns align_or_error of method of Bio.pairwise2, computed once for each method and arguments
+        of the last pair of sequences, as tests of a pair compare it with many variants of optimized code """
+    if _original_results.get("sequences") != (seq1, seq2):
+        _original_results.clear()
+        _original_results["sequences"] = (seq1, seq2)
+    defaults = dict(DEFAULT_KEYWORD_ARGUMENTS, penalize_end_gaps=method_name.startswith("global"))
+    key = (method_name, repr(args), repr(sorted(dict(defaults, **kwargs).items())))
+    if key not in _original_results:
+        _original_results[key] = align_or_error(pairwise2.align.__getattr__(method_name), seq1, seq2, *args, **kwargs)
+    return _original_results[key]
+
+
+class UnpicklableError(Exception):
+    """ Error of a match function, which can not be sent back from a worker process """
+
+    def __init__(self):
+        Exception.__init__(self)
+        self.function = lambda: None
+
+
+def unpicklable_error_match(charA, charB):
+    raise UnpicklableError()
 
 
 class AlignmentsEquivalenceTestCase(unittest.TestCase):
@@ -20,7 +79,9 @@ class AlignmentsEquivalenceTestCase(unittest.TestCase):
         ("globalmx", [4, -2]),
         ("localmx", [4, -2]),
         ("globalms", [2, -1, -.5, -.1]),
-        ("localms", [2, -1, -.5, -.1])
+        ("localms", [2, -1, -.5, -.1]),
+        ("globalds", [blosum62, -10, -1]),
+        ("localds", [blosum62, -10, -1])
     ]
 
     """ Keyword arguments possible for all methods """
@@ -30,6 +91,14 @@ class AlignmentsEquivalenceTestCase(unittest.TestCase):
         "one_alignment_only": [True, False],
     }
 
+    """ Variants of optimized code (engines, checkpointed matrices, band), each is compared with original code
+        on the first VARIANTS_MAX_LENGTH symbols of sequences, as the product of all of them is slow """
+    variants = [{"engine": engine} for engine in sorted(opt_pairwise2.SCORE_MATRIX_ENGINES)]
+    if "numpy" in opt_pairwise2.SCORE_MATRIX_ENGINES:
+        variants.append({"engine": "numpy", "checkpointed": True})
+        variants.append({"engine": "numpy", "band": 4})
+    VARIANTS_MAX_LENGTH = 60
+
     def __init__(self, testname, seq1, seq2):
         unittest.TestCase.__init__(self, testname)
         self.seq1 = seq1
@@ -45,6 +114,11 @@ class AlignmentsEquivalenceTestCase(unittest.TestCase):
     def assert_alignments(self, results):
         """ Test that given lists of alignments are equal """
 
+        # methods may fail only all together, with the same error
+        if any(isinstance(r, type) for r in results):
+            self.assertTrue(all_equal(results))
+            return
+
         # first assert that methods return same counts of alignments
         self.assertTrue(all_equal(list(map(len, results))))
         alignments_count = len(results[0])
@@ -60,16 +134,18 @@ class AlignmentsEquivalenceTestCase(unittest.TestCase):
                 alignments_fields = [al[j] for al in alignments]
                 self.assertTrue(all_equal(alignments_fields))
 
-    def run_tests(self, score_only=False):
-        """ Runs tests for all parameters combinations """
+    def run_tests(self, seq1, seq2, variants=({},), score_only=False):
+        """ Runs tests for all parameters combinations, for each of given variants of optimized code """
         kwargs_combinations = self.get_all_kwargs_combinations(score_only=score_only)
 
         for method_name, args in AlignmentsEquivalenceTestCase.test_cases:
-            methods = [pairwise2.align.__getattr__(method_name),
-                       opt_pairwise2.align.__getattr__(method_name)]
+            methods = [functools.partial(opt_pairwise2.align.__getattr__(method_name), **variant)
+                       for variant in variants if "band" not in variant or method_name.startswith("global")]
             for kwargs in kwargs_combinations:
-                # results - list of results from each method. Each result = list of alignments or score
-                results = [method(self.seq1, self.seq2, *args, **kwargs) for method in methods]
+                # results - list of results from original and each optimized method.
+                # Each result = list of alignments or score
+                results = [original_result(method_name, seq1, seq2, *args, **kwargs)]
+                results.extend(align_or_error(method, seq1, seq2, *args, **kwargs) for method in methods)
                 if score_only:
                     self.assertTrue(all_equal(results))
                 else:
@@ -78,27 +154,545 @@ class AlignmentsEquivalenceTestCase(unittest.TestCase):
 
     def test_scores_equivalence(self):
         """ Test all test cases with all kwargs combinations for score with score_only=True option. """
-        self.run_tests(score_only=True)
+        self.run_tests(self.seq1, self.seq2, score_only=True)
 
     def test_alignments_equivalence(self):
         """ Test all test cases with all kwargs combinations for equivalence of alignments. """
-        self.run_tests()
+        self.run_tests(self.seq1, self.seq2)
+
+    def test_variants_equivalence(self):
+        """ Test all test cases with all kwargs combinations for scores and alignments of every variant,
+            on beginnings of sequences. """
+        seq1, seq2 = self.seq1[:self.VARIANTS_MAX_LENGTH], self.seq2[:self.VARIANTS_MAX_LENGTH]
+        self.run_tests(seq1, seq2, self.variants, score_only=True)
+        self.run_tests(seq1, seq2, self.variants)
+
+    def test_lazy_alignments(self):
+        """ Test that alignments are yielded lazily in the same order, and that max_alignments takes the first ones. """
+        for method_name, args in AlignmentsEquivalenceTestCase.test_cases:
+            expected = original_result(method_name, self.seq1, self.seq2, *args)
+            method = opt_pairwise2.align.__getattr__(method_name)
+            lazy_method = lambda *args: list(method(*args, lazy=True))
+            self.assertEqual(align_or_error(lazy_method, self.seq1, self.seq2, *args), expected)
+            if expected is not KeyError:
+                self.assertEqual(method(self.seq1, self.seq2, *args, max_alignments=2), expected[:2])
+        # an iterator is returned even if there is nothing to align
+        alignments = opt_pairwise2.align.globalxx(self.seq1, '', lazy=True)
+        self.assertIs(iter(alignments), alignments)
+        self.assertEqual(list(alignments), [])
+
+    def test_list_alignments(self):
+        """ Test that alignments of lists of multi-character symbols are the same, with the symbols kept whole. """
+        seq1 = [symbol * 3 for symbol in self.seq1[:self.VARIANTS_MAX_LENGTH]]
+        seq2 = [symbol * 3 for symbol in self.seq2[:self.VARIANTS_MAX_LENGTH]]
+        for method_name, args in AlignmentsEquivalenceTestCase.test_cases[:6]:
+            expected = pairwise2.align.__getattr__(method_name)(seq1, seq2, *args, gap_char=["-"])
+            method = opt_pairwise2.align.__getattr__(method_name)
+            self.assert_alignments([expected, method(seq1, seq2, *args, gap_char=["-"])])
+            self.assertEqual(list(method(seq1, seq2, *args, gap_char=["-"], lazy=True)), expected)
+
+    def test_min_score(self):
+        """ Test that results reaching min_score are the same, and that lower ones are rejected. """
+        for method_name, args in AlignmentsEquivalenceTestCase.test_cases:
+            score = original_result(method_name, self.seq1, self.seq2, *args, score_only=True)
+            if score in (KeyError, []):
+                continue
+            expected = original_result(method_name, self.seq1, self.seq2, *args, one_alignment_only=True)
+            opt_method = opt_pairwise2.align.__getattr__(method_name)
+            for engine in sorted(opt_pairwise2.SCORE_MATRIX_ENGINES):
+                self.assertEqual(opt_method(self.seq1, self.seq2, *args, score_only=True, min_score=score,
+                                            engine=engine), score)
+                self.assertIsNone(opt_method(self.seq1, self.seq2, *args, score_only=True, min_score=score + 1,
+                                             engine=engine))
+            self.assertEqual(opt_method(self.seq1, self.seq2, *args, one_alignment_only=True, min_score=score),
+                             expected)
+            self.assertEqual(opt_method(self.seq1, self.seq2, *args, min_score=score + 1), [])
+        # xdrop prunes only scores, not alignments
+        self.assertRaises(ValueError, opt_pairwise2.align.localxx, "ACGT", "AGT", xdrop=10)
+
+    def test_checkpointed_matrices(self):
+        """ Test that alignments traced back from checkpoints of matrices are the same, with bands so thin
+            that many of them are recomputed (and dropped from the cache of bands). """
+        if "numpy" not in opt_pairwise2.SCORE_MATRIX_ENGINES:
+            return
+        min_band = opt_pairwise2.numpy_engine.CheckpointedMatrices.min_band
+        opt_pairwise2.numpy_engine.CheckpointedMatrices.min_band = 4
+        try:
+            for method_name, args in AlignmentsEquivalenceTestCase.test_cases:
+                expected = original_result(method_name, self.seq1, self.seq2, *args, one_alignment_only=True)
+                results = align_or_error(opt_pairwise2.align.__getattr__(method_name), self.seq1, self.seq2, *args,
+                                         one_alignment_only=True, engine="numpy", checkpointed=True)
+                self.assertEqual(results, expected)
+        finally:
+            opt_pairwise2.numpy_engine.CheckpointedMatrices.min_band = min_band
+
+    def test_spilled_matrices(self):
+        """ Test that alignments traced back from matrices in memory-mapped files are the same,
+            and that the files are removed. """
+        if "numpy" not in opt_pairwise2.SCORE_MATRIX_ENGINES:
+            return
+        tile_size = opt_pairwise2.numpy_engine.SpilledMatrices.tile_size
+        opt_pairwise2.numpy_engine.SpilledMatrices.tile_size = 96
+        directory = tempfile.mkdtemp()
+        try:
+            for method_name, args in AlignmentsEquivalenceTestCase.test_cases[:6]:
+                expected = original_result(method_name, self.seq1, self.seq2, *args)
+                method = opt_pairwise2.align.__getattr__(method_name)
+                self.assert_alignments([expected, method(self.seq1, self.seq2, *args, spill=directory)])
+                self.assertEqual(list(method(self.seq1, self.seq2, *args, spill=directory, lazy=True)), expected)
+                if self.seq1 and self.seq2:
+                    self.assertRaises(ValueError, method, self.seq1, self.seq2, *args, spill=directory,
+                                      engine="biopython")
+                self.assertEqual(os.listdir(directory), [])
+                # files are removed also when lazy alignments are dropped before the first one is recovered
+                alignments = method(self.seq1, self.seq2, *args, spill=directory, lazy=True)
+                del alignments
+                gc.collect()
+                self.assertEqual(os.listdir(directory), [])
+        finally:
+            opt_pairwise2.numpy_engine.SpilledMatrices.tile_size = tile_size
+            shutil.rmtree(directory)
 
     @staticmethod
     def get_test_suite(sequence_pairs):
         """ Forms a test suites for provided collection of samples """
         t_suite = unittest.TestSuite()
+        # tests of whole sequences of a pair come one after another, reusing results of original code
         for seq1, seq2 in sequence_pairs:
-            t_suite.addTest(AlignmentsEquivalenceTestCase("test_scores_equivalence", seq1, seq2))
-            t_suite.addTest(AlignmentsEquivalenceTestCase("test_alignments_equivalence", seq1, seq2))
+            for testname in ["test_scores_equivalence", "test_alignments_equivalence", "test_lazy_alignments",
+                             "test_min_score", "test_checkpointed_matrices", "test_spilled_matrices",
+                             "test_variants_equivalence", "test_list_alignments"]:
+                t_suite.addTest(AlignmentsEquivalenceTestCase(testname, seq1, seq2))
         return t_suite
 
+class AlignManyTestCase(unittest.TestCase):
+    """ Class with unit tests for testing if batch alignment gives same results as aligning pairs one by one"""
+
+    def __init__(self, testname, sequence_pairs):
+        unittest.TestCase.__init__(self, testname)
+        self.sequence_pairs = sequence_pairs
+
+    def test_align_many(self):
+        """ Test that results of align_many are same as of separate calls, in order and as completed. """
+        for method_name, args in AlignmentsEquivalenceTestCase.test_cases:
+            method = pairwise2.align.__getattr__(method_name)
+            expected = [align_or_error(method, seq1, seq2, *args) for seq1, seq2 in self.sequence_pairs]
+            if KeyError in expected:
+                continue
+            for workers in [1, 2]:
+                results = opt_pairwise2.align_many(self.sequence_pairs, method_name, *args,
+                                                   workers=workers, chunksize=1)
+                self.assertEqual(list(results), expected)
+                results = opt_pairwise2.align_many(self.sequence_pairs, method_name, *args,
+                                                   workers=workers, ordered=False)
+                self.assertEqual(sorted(results), list(enumerate(expected)))
+
+        # pairs are read only when there is room for them among chunks in flight
+        seq1, seq2 = self.sequence_pairs[0]
+        read = []
+        def stream():
+            for index in itertools.count():
+                read.append(index)
+                yield seq1[:20], seq2[:20]
+        for ordered in [True, False]:
+            del read[:]
+            results = opt_pairwise2.align_many(stream(), "globalxx", workers=2, chunksize=3, max_in_flight=2,
+                                               ordered=ordered, score_only=True)
+            next(results)
+            self.assertLessEqual(len(read), 3 * 2 + 1)
+            results.close()
+
+    def test_score_many(self):
+        """ Test that scores of batches of short pairs, and of other pairs, are same as of original code. """
+        pairs = [(seq1[:length], seq2[:length // 2 + 1]) for seq1, seq2 in self.sequence_pairs
+                 for length in [3, 30, 80, 600]]
+        pairs += [(seq2, seq1) for seq1, seq2 in pairs]
+        for method_name, args in AlignmentsEquivalenceTestCase.test_cases:
+            method = pairwise2.align.__getattr__(method_name)
+            for penalize_end_gaps in [True, False]:
+                expected = [align_or_error(method, seq1, seq2, *args, score_only=True,
+                                           penalize_end_gaps=penalize_end_gaps) for seq1, seq2 in pairs]
+                if KeyError in expected:
+                    continue
+                results = opt_pairwise2.score_many(pairs, method_name, *args, penalize_end_gaps=penalize_end_gaps,
+                                                   workers=1, batch_size=5)
+                self.assertEqual(list(results), expected)
+        if opt_pairwise2.numpy_engine is not None:
+            self.assertRaises(ValueError, opt_pairwise2.numpy_engine.compute_scores, pairs[:2],
+                              pairwise2.identity_match(), 1, 0, -1, 0, False, (True, True), False)
+
+
+class SearchTestCase(unittest.TestCase):
+    """ Class with unit tests for testing if database search finds the same best scores and alignments"""
+
+    def __init__(self, testname, query, database):
+        unittest.TestCase.__init__(self, testname)
+        self.query = query
+        self.database = database
+
+    def test_search(self):
+        """ Test that search returns targets with the best scores, in order, with their alignments. """
+        top_k = 3
+        for method_name, args in AlignmentsEquivalenceTestCase.test_cases:
+            method = pairwise2.align.__getattr__(method_name)
+            scores = [(align_or_error(method, self.query, target, *args, score_only=True), -index)
+                      for index, target in enumerate(self.database) if target]
+            if any(score is KeyError for score, _ in scores):
+                continue
+            expected = [(-index, score) for score, index in sorted(scores, reverse=True)[:top_k]]
+            results = opt_pairwise2.search(self.query, iter(self.database), method_name, *args, top_k=top_k)
+            self.assertEqual([(index, score) for index, score, _ in results], expected)
+            for index, _, alignments in results:
+                self.assertEqual(alignments, method(self.query, self.database[index], *args))
+
+    def test_search_min_score(self):
+        """ Test that targets not reaching min_score are skipped, with or without query profile. """
+        # beginnings of sequences, as original code calls match function of dictionary for every cell
+        query, database = self.query[:300], [target[:300] for target in self.database]
+        # fewer targets than top_k reach min_score
+        top_k = len(database)
+        # dictionary of all symbols of the data, so that scores are computed with query profile
+        symbols = set(query).union(*database)
+        match_dict = dict(((a, b), 2 if a == b else -1) for a in symbols for b in symbols)
+        test_cases = AlignmentsEquivalenceTestCase.test_cases + [("globalds", [match_dict, -1, -.5]),
+                                                                 ("localds", [match_dict, -1, -.5])]
+        for method_name, args in test_cases:
+            method = pairwise2.align.__getattr__(method_name)
+            scores = [(align_or_error(method, query, target, *args, score_only=True), -index)
+                      for index, target in enumerate(database) if target]
+            if any(score is KeyError for score, _ in scores):
+                continue
+            min_score = sorted(score for score, _ in scores)[len(scores) // 2]
+            expected = [(-index, score) for score, index in sorted(scores, reverse=True) if score >= min_score]
+            self.assertLess(len(expected), top_k)
+            results = opt_pairwise2.search(query, iter(database), method_name, *args, top_k=top_k,
+                                           min_score=min_score, score_only=True)
+            self.assertEqual(results, expected)
+
+
+class PipelineTestCase(unittest.TestCase):
+    """ Class with unit tests for testing if streaming pipeline reads FASTA pairs and aligns them as original code"""
+
+    def __init__(self, testname, sequence_pairs):
+        unittest.TestCase.__init__(self, testname)
+        self.sequence_pairs = sequence_pairs
+
+    def test_pipeline(self):
+        """ Test that pairs of FASTA records are aligned in order, with bounded number of chunks in flight. """
+        fasta = "".join(">seq{0} description\n{1}\n{2}\n".format(i, seq[:50], seq[50:])
+                        for i, seq in enumerate(itertools.chain.from_iterable(self.sequence_pairs)))
+        pairs = list(align_pipeline.read_fasta(fasta.splitlines(True)))
+        self.assertEqual([seq for _, seq in pairs], list(itertools.chain.from_iterable(self.sequence_pairs)))
+        for workers in [1, 2]:
+            records = iter(pairs)
+            results = align_pipeline.align_pairs(itertools.izip(records, records), "globalms", 2, -1, -.5, -.1,
+                                                 workers=workers, chunksize=1, max_in_flight=2)
+            for (seq1, seq2), (record_A, record_B, result) in itertools.izip_longest(self.sequence_pairs, results):
+                self.assertEqual((record_A[1], record_B[1]), (seq1, seq2))
+                self.assertEqual(result, pairwise2.align.globalms(seq1, seq2, 2, -1, -.5, -.1))
+
+
+class CacheTestCase(unittest.TestCase):
+    """ Class with unit tests for testing if cached results are same as computed ones"""
+
+    def __init__(self, testname, sequence_pairs):
+        unittest.TestCase.__init__(self, testname)
+        self.sequence_pairs = sequence_pairs
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cache.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache(self):
+        """ Test that results are found in memory and on disk tier, and that disk tier is evicted. """
+        method = opt_pairwise2.align.localms
+        expected = [pairwise2.align.localms(seq1, seq2, 2, -1, -.5, -.1) for seq1, seq2 in self.sequence_pairs]
+        cache = AlignmentCache(self.path, memory_items=1)
+        for _ in xrange(2):
+            self.assertEqual([method(seq1, seq2, 2, -1, -.5, -.1, cache=cache) for seq1, seq2 in self.sequence_pairs],
+                             expected)
+        # with one result in memory, results of the second pass are read from disk
+        self.assertEqual((cache.misses, cache.disk_hits), (len(expected), len(expected)))
+        self.assertEqual(method(*self.sequence_pairs[-1] + (2, -1, -.5, -.1), cache=cache, engine="numpy"),
+                         expected[-1])
+        self.assertEqual(cache.memory_hits, 1)
+        disk_bytes = cache.stats()["disk_bytes"]
+        cache.close()
+
+        # a new cache reads results of the previous one, the oldest results are evicted when file is too big
+        cache = AlignmentCache(self.path, disk_bytes=disk_bytes - 1)
+        self.assertEqual(method(*self.sequence_pairs[-1] + (2, -1, -.5, -.1), cache=cache), expected[-1])
+        self.assertEqual(method(*self.sequence_pairs[0] + (2, -1, -1, -.5), cache=cache),
+                         pairwise2.align.localms(*self.sequence_pairs[0] + (2, -1, -1, -.5)))
+        self.assertEqual((cache.disk_hits, cache.misses), (1, 1))
+        self.assertLessEqual(cache.stats()["disk_bytes"], cache.disk_bytes)
+        cache.close()
+
+        # a result stored again replaces the old row, its size is not counted twice
+        cache = AlignmentCache(self.path)
+        for _ in xrange(2):
+            cache._put("key", "value")
+        self.assertEqual(cache._disk_total, cache.stats()["disk_bytes"])
+        cache.close()
+
+
+class ProfilingTestCase(unittest.TestCase):
+    """ Class with unit tests for testing if profiling counts alignments and does not change them"""
+
+    def __init__(self, testname, sequence_pairs):
+        unittest.TestCase.__init__(self, testname)
+        self.sequence_pairs = sequence_pairs
+
+    def test_profiling(self):
+        """ Test that calls, cells and recovered alignments are counted, with time of all stages. """
+        expected = [pairwise2.align.globalms(seq1, seq2, 2, -1, -.5, -.1) for seq1, seq2 in self.sequence_pairs]
+        with profiling.profile() as stats:
+            results = [opt_pairwise2.align.globalms(seq1, seq2, 2, -1, -.5, -.1) for seq1, seq2 in self.sequence_pairs]
+            with profiling.profile() as inner_stats:
+                opt_pairwise2.align.globalms(self.sequence_pairs[0][0], self.sequence_pairs[0][1], 2, -1, -.5, -.1,
+                                             score_only=True)
+        self.assertEqual(results, expected)
+        self.assertEqual((inner_stats.calls, inner_stats.alignments), (1, 0))
+        self.assertEqual(stats.calls, len(self.sequence_pairs) + 1)
+        self.assertEqual(stats.alignments, sum(map(len, expected)))
+        self.assertEqual(stats.cells, sum(len(seq1) * len(seq2) for seq1, seq2 in self.sequence_pairs) +
+                         inner_stats.cells)
+        self.assertTrue(all(stats.seconds[stage] > 0 for stage in profiling.STAGES))
+
+        # score pass of min_score is a part of the same call, its cells are not counted again by the full fill
+        seq1, seq2 = self.sequence_pairs[0]
+        for engine in ["biopython", "numpy"]:
+            with profiling.profile() as stats:
+                opt_pairwise2.align.globalms(seq1, seq2, 2, -1, -.5, -.1, min_score=-1e9, engine=engine)
+            self.assertEqual((stats.calls, stats.cells), (1, len(seq1) * len(seq2)))
+
+        # pairs of a batch of score_many are counted as calls, as if aligned one by one
+        pairs = [(first[:length], second[:length]) for first, second in self.sequence_pairs if first and second
+                 for length in [5, 50]]
+        with profiling.profile() as stats:
+            list(opt_pairwise2.score_many(pairs, "globalms", 2, -1, -.5, -.1, workers=1, batch_size=3))
+        self.assertEqual((stats.calls, stats.cells), (len(pairs), sum(len(a) * len(b) for a, b in pairs)))
+
+
+class ServiceTestCase(unittest.TestCase):
+    """ Class with unit tests for testing if alignment service and its HTTP server align as original code"""
+
+    def __init__(self, testname, sequence_pairs):
+        unittest.TestCase.__init__(self, testname)
+        self.sequence_pairs = sequence_pairs
+
+    def test_service(self):
+        """ Test results of concurrent requests, timeouts, cancelling and requests to HTTP server. """
+        expected = [pairwise2.align.globalms(seq1, seq2, 2, -1, -.5, -.1) for seq1, seq2 in self.sequence_pairs]
+        with align_service.AlignmentService(workers=2, batch_size=2, max_pending=4) as service:
+            requests = [service.submit("globalms", seq1, seq2, 2, -1, -.5, -.1) for seq1, seq2 in self.sequence_pairs]
+            self.assertEqual([r.result() for r in requests], expected)
+
+            long_seq1, long_seq2 = self.sequence_pairs[0][0] * 8, self.sequence_pairs[0][1] * 8
+            request = service.submit("globalxx", long_seq1, long_seq2, timeout=0)
+            self.assertRaises(align_service.AlignmentTimeout, request.result)
+            request = service.submit("globalxx", long_seq1, long_seq2)
+            self.assertTrue(request.cancel())
+            self.assertRaises(align_service.AlignmentCancelled, request.result)
+
+            # an error, which can not be sent back from worker, fails only its request
+            seq1, seq2 = self.sequence_pairs[0]
+            request = service.submit("globalcx", seq1, seq2, unpicklable_error_match)
+            self.assertRaises(align_service.AlignmentError, request.result)
+            self.assertEqual(service.submit("globalxx", seq1, seq2, score_only=True).result(),
+                             pairwise2.align.globalxx(seq1, seq2, score_only=True))
+
+            # callbacks of expired requests can submit requests
+            submitted = []
+            callback_done = threading.Event()
+            def submit_again(expired):
+                submitted.append(service.submit("globalxx", seq1, seq2, score_only=True))
+                callback_done.set()
+            service.submit("globalxx", long_seq1, long_seq2, timeout=0).add_done_callback(submit_again)
+            self.assertTrue(callback_done.wait(10))
+            self.assertEqual(submitted[0].result(), pairwise2.align.globalxx(seq1, seq2, score_only=True))
+
+            # requests done before their deadlines are not kept until then
+            requests = [service.submit("globalxx", seq1, seq2, score_only=True, timeout=3600) for _ in range(20)]
+            self.assertEqual([r.result() for r in requests], [requests[0].result()] * 20)
+            for _ in range(100):
+                if not service._deadlines:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(service._deadlines, [])
+
+            # an exception of a callback is logged, and does not stop the thread calling callbacks of results
+            records = []
+            handler = logging.Handler()
+            handler.emit = records.append
+            align_service.LOGGER.addHandler(handler)
+            try:
+                def failing_callback(request):
+                    raise RuntimeError("error of callback")
+                callback_done.clear()
+                request = service.submit("globalxx", seq1, seq2, score_only=True)
+                request.add_done_callback(failing_callback)
+                request.add_done_callback(lambda request: callback_done.set())
+                self.assertTrue(callback_done.wait(10))
+                self.assertEqual(service.submit("globalxx", seq1, seq2, score_only=True).result(timeout=10),
+                                 pairwise2.align.globalxx(seq1, seq2, score_only=True))
+            finally:
+                align_service.LOGGER.removeHandler(handler)
+            self.assertEqual(len(records), 1)
+
+            server = align_service.make_server(("127.0.0.1", 0), service)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                connection = httplib.HTTPConnection(*server.server_address)
+                seq1, seq2 = self.sequence_pairs[0]
+                connection.request("POST", "/align", json.dumps({"mode": "globalms", "sequenceA": seq1,
+                                                                 "sequenceB": seq2, "args": [2, -1, -.5, -.1],
+                                                                 "keywds": {"score_only": True}}))
+                response = connection.getresponse()
+                self.assertEqual(response.status, 200)
+                self.assertEqual(json.loads(response.read()), {"score": expected[0][0][2]})
+            finally:
+                server.shutdown()
+                thread.join()
+                server.server_close()
+
+    def test_service_busy(self):
+        """ Test that align_async and HTTP server reject requests at once, when the queue is full. """
+        long_seq1, long_seq2 = self.sequence_pairs[0][0] * 8, self.sequence_pairs[0][1] * 8
+        seq1, seq2 = self.sequence_pairs[0]
+        service = align_service.AlignmentService(workers=1, batch_size=1, max_pending=1, max_batches=1)
+        server = align_service.make_server(("127.0.0.1", 0), service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        align_service._default_service = service
+        try:
+            # the worker computes a long alignment, the next one waits in queue, which is then full
+            service.submit("globalxx", long_seq1, long_seq2, score_only=True)
+            while not service.stats()["batches_in_flight"]:
+                time.sleep(0.01)
+            service.submit("globalxx", long_seq1, long_seq2, score_only=True)
+            start = timer()
+            request = align_service.align_async("globalxx", seq1, seq2, score_only=True)
+            self.assertTrue(request.done())
+            self.assertRaises(align_service.ServiceBusy, request.result)
+
+            connection = httplib.HTTPConnection(*server.server_address)
+            connection.request("POST", "/align", json.dumps({"mode": "globalxx", "sequenceA": seq1,
+                                                             "sequenceB": seq2, "keywds": {"score_only": True}}))
+            response = connection.getresponse()
+            self.assertEqual(response.status, 503)
+            self.assertLess(timer() - start, 1)
+            self.assertEqual(service.stats()["rejected"], 2)
+        finally:
+            align_service._default_service = None
+            server.shutdown()
+            thread.join()
+            server.server_close()
+            service.close()
+
+    def test_service_close(self):
+        """ Test that closing the service cancels requests of batches being computed. """
+        long_seq1, long_seq2 = self.sequence_pairs[0][0] * 8, self.sequence_pairs[0][1] * 8
+        service = align_service.AlignmentService(workers=1, batch_size=1)
+        try:
+            request = service.submit("globalxx", long_seq1, long_seq2, score_only=True)
+            while not service.stats()["batches_in_flight"]:
+                time.sleep(0.01)
+        finally:
+            service.close()
+        self.assertTrue(request.done())
+        self.assertRaises(align_service.AlignmentCancelled, request.result, 0)
+        self.assertEqual(service.stats()["batches_in_flight"], 0)
+
+
+class AllVsAllTestCase(unittest.TestCase):
+    """ Class with unit tests for testing if all-vs-all matrix has the same scores as original code"""
+
+    def __init__(self, testname, sequences):
+        unittest.TestCase.__init__(self, testname)
+        self.sequences = sequences
+
+    def test_all_vs_all(self):
+        """ Test scores of all pairs, also of a run interrupted and continued from a memory-mapped file. """
+        n = len(self.sequences)
+        for method_name, args in AlignmentsEquivalenceTestCase.test_cases:
+            method = pairwise2.align.__getattr__(method_name)
+            expected = [align_or_error(method, self.sequences[i], self.sequences[j], *args, score_only=True)
+                        for i in xrange(n) for j in xrange(i + 1, n)]
+            if KeyError in expected:
+                continue
+            for workers in [1, 2]:
+                results = all_vs_all.all_vs_all(self.sequences, method_name, *args, workers=workers, chunk_size=7)
+                self.assertEqual(list(results), expected)
+
+        # scores of swapped sequences may differ with other penalties of gaps in A and in B, or own match function
+        self.assertRaises(ValueError, all_vs_all.all_vs_all, self.sequences, "globalmd", 2, -1, -1, -.5, -2, -.5)
+        self.assertRaises(ValueError, all_vs_all.all_vs_all, self.sequences, "globalms", 2, -1, -1, -.5,
+                          penalize_end_gaps=(True, False))
+        self.assertRaises(ValueError, all_vs_all.all_vs_all, self.sequences, "globalcx", lambda a, b: a < b)
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(done, size):
+            raise Interrupted()
+
+        directory = tempfile.mkdtemp()
+        output = os.path.join(directory, "scores.npy")
+        try:
+            self.assertRaises(Interrupted, all_vs_all.all_vs_all, self.sequences, "globalxx", workers=1,
+                              chunk_size=7, output=output, progress=interrupt)
+            # a run with other arguments does not continue the interrupted one
+            self.assertRaises(ValueError, all_vs_all.all_vs_all, self.sequences, "globalmx", 1, -1, workers=1,
+                              chunk_size=7, output=output)
+            progress = []
+            results = all_vs_all.all_vs_all(self.sequences, "globalxx", workers=1, chunk_size=7, output=output,
+                                             progress=lambda done, size: progress.append(done))
+            self.assertEqual(progress[0], 14)
+            self.assertEqual(list(results), [pairwise2.align.globalxx(self.sequences[i], self.sequences[j],
+                                                                      score_only=True)
+                                             for i in xrange(n) for j in xrange(i + 1, n)])
+            self.assertEqual(os.listdir(directory), ["scores.npy"])
+        finally:
+            shutil.rmtree(directory)
+
+
+class FuzzTestCase(unittest.TestCase):
+    """ Class with unit tests comparing random cases of all alignment modes with original code"""
+
+    def test_fuzz(self):
+        """ Test that generated cases of all modes, keyword arguments and variants give same results. """
+        report = run_fuzz.run_fuzz(seed=0, count=50, max_length=30, alphabets=sorted(run_fuzz.ALPHABETS))
+        self.assertEqual(report["failures"], [])
+        self.assertTrue(len(report["skipped"]) < 5)
+
+
 if __name__ == "__main__":
     print("Tested methods: ")
     print("Running unit tests (might take a while)...")
-    print("\n".join("{0}, args: {1}".format(m, str(args)) for m, args in AlignmentsEquivalenceTestCase.test_cases))
+    # substitution matrix is printed by name, not as a whole dictionary
+    print("\n".join("{0}, args: [{1}]".format(m, ", ".join("blosum62" if arg is blosum62 else str(arg) for arg in args))
+                    for m, args in AlignmentsEquivalenceTestCase.test_cases))
 
     sequence_pairs = [(seq1, seq2) for _, seq1, seq2 in get_test_sequences_pairs(['unit'])]
     test_suite = AlignmentsEquivalenceTestCase.get_test_suite(sequence_pairs)
+    test_suite.addTest(AlignManyTestCase("test_align_many", sequence_pairs))
+    test_suite.addTest(AlignManyTestCase("test_score_many", sequence_pairs))
+    test_suite.addTest(PipelineTestCase("test_pipeline", sequence_pairs))
+    test_suite.addTest(CacheTestCase("test_cache", sequence_pairs))
+    test_suite.addTest(ProfilingTestCase("test_profiling", sequence_pairs))
+    test_suite.addTest(ServiceTestCase("test_service", sequence_pairs))
+    test_suite.addTest(ServiceTestCase("test_service_busy", sequence_pairs))
+    test_suite.addTest(ServiceTestCase("test_service_close", sequence_pairs))
+    sequences = [seq[:100] for pair in sequence_pairs for seq in pair if seq]
+    test_suite.addTest(AllVsAllTestCase("test_all_vs_all", sequences))
+    test_suite.addTest(FuzzTestCase("test_fuzz"))
+    test_suite.addTest(SearchTestCase("test_search", sequence_pairs[0][0], [seq2 for _, seq2 in sequence_pairs]))
+    test_suite.addTest(SearchTestCase("test_search_min_score", sequence_pairs[0][0],
+                                      [seq2 for _, seq2 in sequence_pairs]))
 
     unittest.TextTestRunner().run(test_suite)
\ No newline at end of file
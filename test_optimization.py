@@ -3,8 +3,6 @@
 from timeit import default_timer as timer
 from Bio import pairwise2
 from lib import optimized_pairwise2
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
 import os.path
 from itertools import cycle
 from testdata.test_sequences import get_test_sequences_pairs
@@ -37,6 +35,7 @@ def save_plot(directory, filename):
     """ Saves current plot in given directory """
     if not os.path.exists(directory):
         os.makedirs(directory)
+    import matplotlib.pyplot as plt
     plt.savefig(os.path.join(directory, filename))
 
 def run_compare_test(description, compared_methods, *args, **kwargs):
@@ -48,6 +47,9 @@ def run_compare_test(description, compared_methods, *args, **kwargs):
         results.append(result)
     results.sort(key=lambda x: x[0])
     
+    # matplotlib is imported only for plotting, it is slow to import
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as mpatches
     fig = plt.figure() 
     fig.canvas.set_window_title(description) 
     plt.title(description)